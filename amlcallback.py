@@ -1,23 +1,93 @@
+import time
+import queue
+import threading
 import tensorflow as tf
 
 
 class AMLCallback(tf.keras.callbacks.Callback):
 
-    def __init__(self, run):
+    def __init__(self, run, every=100, interval=30.):
+        super(AMLCallback, self).__init__()
         self.run = run
         self.local = self.run.id.startswith('OfflineRun')
+        # batch metrics are summarized every `every` steps or `interval`
+        # seconds, whichever comes first, and logged off the training thread
+        self.every = every
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.worker = None
+        self.step = 0
+        self.reset()
+
+    def reset(self):
+        self.window = {}
+        self.window_steps = 0
+        self.window_start = time.time()
+
+    def start(self):
+        if self.worker is None and not self.local:
+            self.worker = threading.Thread(target=self.consume, name='AMLCallback', daemon=True)
+            self.worker.start()
+
+    def consume(self):
+        done = False
+        while not done:
+            items = [self.queue.get()]
+            # drain whatever piled up so several windows go out in one call
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            done = items[-1] is None
+            rows = [i[1] for i in items if i is not None and i[0] == 'row']
+            metrics = [i[1:] for i in items if i is not None and i[0] == 'log']
+            try:
+                if len(rows) > 0:
+                    self.run.log_table('batch', dict((k, [r[k] for r in rows]) for k in rows[0].keys()))
+                for name, value in metrics:
+                    self.run.log(name, value)
+            except Exception as e:
+                print('AMLCallback: logging failed ({})'.format(e))
+
+    def flush(self):
+        if self.window_steps > 0:
+            row = { 'step': self.step, 'steps': self.window_steps }
+            for k, (total, low, high) in self.window.items():
+                row[f'{k}_mean'] = total / self.window_steps
+                row[f'{k}_min'] = low
+                row[f'{k}_max'] = high
+            self.queue.put(('row', row))
+        self.reset()
+
+    def on_train_begin(self, logs=None):
+        self.start()
 
     def on_train_end(self, logs=None):
-        if logs != None and not self.local:
+        if self.local or self.worker is None:
+            return
+        self.flush()
+        if logs != None:
             for k in logs.keys():
-                self.run.log(f'final_{k}', logs[k])
+                self.queue.put(('log', f'final_{k}', float(logs[k])))
+        # wait for everything queued so far to reach the run
+        self.queue.put(None)
+        self.worker.join()
+        self.worker = None
+        if hasattr(self.run, 'flush'):
+            self.run.flush()
 
     def on_epoch_end(self, epoch, logs=None):
         if logs != None and not self.local:
             for k in logs.keys():
-                self.run.log(f'epoch_{k}', logs[k])
+                self.queue.put(('log', f'epoch_{k}', float(logs[k])))
 
     def on_train_batch_end(self, batch, logs=None):
         if logs != None and not self.local:
+            self.step += 1
+            self.window_steps += 1
             for k in logs.keys():
-                self.run.log(f'{k}', logs[k])
+                if k in ['batch', 'size']:
+                    continue
+                v = float(logs[k])
+                total, low, high = self.window.get(k, (0., v, v))
+                self.window[k] = (total + v, min(low, v), max(high, v))
+            if self.window_steps >= self.every or time.time() - self.window_start >= self.interval:
+                self.flush()
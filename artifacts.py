@@ -0,0 +1,127 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from datetime import datetime
+
+def file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def reflink(source, target):
+    # copy-on-write clone (btrfs, xfs) through the Linux FICLONE ioctl
+    import fcntl
+    FICLONE = 0x40049409
+    with open(source, 'rb') as s, open(target, 'wb') as t:
+        fcntl.ioctl(t.fileno(), FICLONE, s.fileno())
+
+class ArtifactStore(object):
+    """Files kept once under their SHA-256, checked out as links."""
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        if not os.path.exists(self.objects):
+            os.makedirs(self.objects)
+
+    def path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def put(self, path):
+        digest = file_digest(path)
+        target = self.path(digest)
+        if os.path.exists(target):
+            print('{} already stored as {}'.format(path, digest))
+            os.chmod(target, 0o444)
+            return digest
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # write next to the final name and rename so a crash never leaves
+        # a truncated object behind under a valid digest
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target))
+        os.close(fd)
+        shutil.copyfile(str(path), tmp)
+        # read-only, a hard link checked out by link() shares this inode and
+        # an in-place write to it would corrupt the stored object
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, target)
+        print('Stored {} as {}'.format(path, digest))
+        return digest
+
+    def link(self, digest, target):
+        source = self.path(digest)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+            return 'hardlink'
+        except OSError:
+            pass
+        try:
+            reflink(source, target)
+            return 'reflink'
+        except (ImportError, OSError):
+            pass
+        shutil.copyfile(source, target)
+        return 'copy'
+
+class LocalRegistry(object):
+    """Model registry kept in a json file, stands in for the AML one."""
+
+    def __init__(self, root):
+        self.index_file = os.path.join(root, 'registry.json')
+        self.index = { 'models': {} }
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+
+    def save(self):
+        with open(self.index_file, 'w') as f:
+            json.dump(self.index, f, indent=2)
+
+    def find(self, name, digest):
+        for model in self.index['models'].get(name, []):
+            if model['tags'].get('sha256') == digest:
+                return model
+        return None
+
+    def register(self, name, path, tags):
+        versions = self.index['models'].setdefault(name, [])
+        model = {
+            'name': name,
+            'version': len(versions) + 1,
+            'path': path,
+            'tags': dict(tags),
+            'registered': datetime.now().strftime('%m/%d/%y %H:%M:%S')
+        }
+        versions.append(model)
+        self.save()
+        return model
+
+    def tag(self, model, tags):
+        model['tags'].update(tags)
+        self.save()
+        return model
+
+class AMLRegistry(object):
+    def __init__(self, run):
+        self.run = run
+        self.workspace = run.experiment.workspace
+
+    def find(self, name, digest):
+        from azureml.core.model import Model
+        models = Model.list(self.workspace, name=name, tags=[['sha256', digest]])
+        return models[0] if len(models) > 0 else None
+
+    def register(self, name, path, tags):
+        print(f'Uploading {path} to run {self.run.id} as the "modelfiles" folder')
+        self.run.upload_folder('modelfiles', path)
+        return self.run.register_model(model_name=name, model_path='modelfiles', tags=tags)
+
+    def tag(self, model, tags):
+        model.add_tags(tags)
+        return model
@@ -0,0 +1,57 @@
+import os
+# timing comparison is meant for CPU nodes
+os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+import shutil
+import argparse
+import tempfile
+import prep
+import train
+from azureml.core.run import Run
+from benchutils import info, synthetic_images, Timer, write_results
+
+def main(source_path, work_path, per_category, finetune_epochs, bottleneck_epochs, batch, output):
+    cleanup = work_path is None
+    work_path = work_path or tempfile.mkdtemp(prefix='seer-bench-')
+    try:
+        prep_path = os.path.join(work_path, 'prep')
+        if source_path is None:
+            info('Generating synthetic images')
+            source_path = synthetic_images(os.path.join(work_path, 'raw'), per_category=per_category)
+        prep.main(source_path, prep_path, records=16, image_size=160, force=True, workers=os.cpu_count(),
+                  seed=42, record_format='uint8', incremental=False)
+
+        run = Run.get_context()
+        results = {}
+        runs = [('finetune', finetune_epochs), ('bottleneck', bottleneck_epochs), ('bottleneck_cached', bottleneck_epochs)]
+        for name, epochs in runs:
+            info('Mode: {} ({} epochs)'.format(name, epochs))
+            # the second bottleneck run reuses the embeddings of the first
+            mode = 'bottleneck' if name.startswith('bottleneck') else 'finetune'
+            with Timer() as t:
+                train.main(run, prep_path, os.path.join(work_path, name), epochs, batch, 0.001,
+                           cache_path=os.path.join(work_path, 'cache'), mode=mode)
+            results[name] = { 'epochs': epochs, 'seconds': t.elapsed, 'seconds_per_epoch': t.elapsed / epochs }
+
+        info('Results')
+        for name, r in results.items():
+            print('{:>18} {:>4} epochs {:>9.1f}s ({:.2f}s/epoch)'.format(name, r['epochs'], r['seconds'], r['seconds_per_epoch']))
+
+        if output:
+            write_results(output, 'bottleneck', results)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='bottleneck vs full fine tuning on CPU')
+    parser.add_argument('-s', '--source_path', help='directory to raw data (synthetic if omitted)', default=None)
+    parser.add_argument('-w', '--work_path', help='scratch directory (temporary if omitted)', default=None)
+    parser.add_argument('-n', '--per_category', help='synthetic images per category', default=128, type=int)
+    parser.add_argument('--finetune_epochs', help='epochs of full fine tuning', default=2, type=int)
+    parser.add_argument('--bottleneck_epochs', help='epochs of head training', default=50, type=int)
+    parser.add_argument('-b', '--batch', help='batch size', default=32, type=int)
+    parser.add_argument('-o', '--output', help='json result file', default=None)
+    args = parser.parse_args()
+
+    main(**vars(args))
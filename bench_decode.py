@@ -0,0 +1,98 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+from benchutils import info, synthetic_jpeg, memory, reset_peak, percentiles, write_results
+
+MODES = ['full', 'reduced']
+
+def corpus(path, images, height, width):
+    # phone sized photos plus the awkward cases: grayscale, rotated by EXIF
+    # orientation and RGBA
+    from PIL import Image
+    os.makedirs(path)
+    files = [synthetic_jpeg(os.path.join(path, 'img{:03d}.jpg'.format(i)), height, width, seed=i) for i in range(images)]
+    base = Image.open(files[0])
+    base.convert('L').save(os.path.join(path, 'gray.jpg'), quality=90)
+    exif = base.getexif()
+    exif[0x0112] = 6
+    base.save(os.path.join(path, 'rotated.jpg'), quality=90, exif=exif)
+    rgba = base.convert('RGBA')
+    rgba.putalpha(128)
+    rgba.save(os.path.join(path, 'rgba.png'))
+    return files + [os.path.join(path, name) for name in ['gray.jpg', 'rotated.jpg', 'rgba.png']]
+
+def measure(mode, files, image_size, repeat):
+    # fresh process per mode so one mode's allocations don't hide the other's
+    import score
+    score.image_size = image_size
+    score.FAST_DECODE = mode == 'reduced'
+    score.process_image(files[0])
+
+    times, peaks, outputs = [], [], []
+    can_reset = reset_peak()
+    for path in files:
+        for _ in range(repeat):
+            reset_peak()
+            before = memory()['rss_mb']
+            start = time.perf_counter()
+            tensor = score.process_image(path)
+            times.append(time.perf_counter() - start)
+            peaks.append(memory()['peak_rss_mb'] - before)
+        outputs.append(tensor.numpy())
+
+    result = dict((k + '_ms', v * 1000.) for k, v in percentiles(times).items())
+    result['mean_ms'] = float(np.mean(times)) * 1000.
+    if can_reset:
+        result.update(dict(('peak_rss_' + k + '_mb', v) for k, v in percentiles(peaks).items()))
+    result['peak_rss_mb'] = memory()['peak_rss_mb']
+    result['shapes'] = sorted(set(str(o.shape) for o in outputs))
+    return result, np.stack(outputs)
+
+def main(work_path, images, height, width, image_size, repeat, output):
+    cleanup = work_path is None
+    work_path = work_path or tempfile.mkdtemp(prefix='seer-bench-')
+    try:
+        info('Generating {} {}x{} JPEGs'.format(images, width, height))
+        files = corpus(os.path.join(work_path, 'images'), images, height, width)
+
+        results, outputs = {}, {}
+        context = multiprocessing.get_context('spawn')
+        for mode in MODES:
+            info('Decode: {}'.format(mode))
+            with context.Pool(1) as pool:
+                results[mode], outputs[mode] = pool.apply(measure, (mode, files, image_size, repeat))
+            print('p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms, process peak {peak_rss_mb:.0f}MB'.format(**results[mode]))
+
+        # how far the reduced decode drifts from the full one, in [0, 1] pixel units
+        diff = np.abs(outputs['reduced'] - outputs['full'])
+        results['reduced']['mean_abs_diff'] = float(diff.mean())
+        results['reduced']['max_abs_diff'] = float(diff.max())
+
+        info('Results')
+        print('{:>8} {:>9} {:>9} {:>9} {:>14}'.format('mode', 'mean ms', 'p50 ms', 'p99 ms', 'peak RSS MB'))
+        for mode, r in results.items():
+            print('{:>8} {:>9.1f} {:>9.1f} {:>9.1f} {:>14.0f}'.format(mode, r['mean_ms'], r['p50_ms'], r['p99_ms'], r['peak_rss_mb']))
+        print('reduced vs full: mean abs diff {mean_abs_diff:.4f}, max {max_abs_diff:.4f}'.format(**results['reduced']))
+
+        if output:
+            write_results(output, 'decode', results)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='score.process_image latency and memory, full vs reduced resolution decode')
+    parser.add_argument('-w', '--work_path', help='scratch directory (temporary if omitted)', default=None)
+    parser.add_argument('-n', '--images', help='synthetic photos in the corpus', default=16, type=int)
+    parser.add_argument('--height', help='photo height', default=3024, type=int)
+    parser.add_argument('--width', help='photo width', default=4032, type=int)
+    parser.add_argument('-i', '--image_size', help='model input size', default=160, type=int)
+    parser.add_argument('-r', '--repeat', help='decodes per image', default=5, type=int)
+    parser.add_argument('-o', '--output', help='json result file', default=None)
+    args = parser.parse_args()
+
+    main(**vars(args))
@@ -0,0 +1,83 @@
+import os
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import importlib
+import requests
+from benchutils import info, synthetic_jpeg, bench_model, load, ImageServer, write_results
+
+MODES = ['unpooled', 'pooled', 'pooled_cached', 'prediction_cache']
+
+def main(model_path, work_path, images, batch, concurrency, duration, latency, output):
+    cleanup = work_path is None
+    work_path = work_path or tempfile.mkdtemp(prefix='seer-bench-')
+    try:
+        if model_path is None:
+            info('Building random weight model')
+            model_path = bench_model(os.path.join(work_path, 'model'))
+
+        info('Generating {} images'.format(images))
+        image_path = os.path.join(work_path, 'images')
+        os.makedirs(image_path)
+        names = [os.path.basename(synthetic_jpeg(os.path.join(image_path, 'img{:05d}.jpg'.format(i)), seed=i))
+                 for i in range(images)]
+
+        import score
+        score = importlib.reload(score)
+        score.init(model_path)
+
+        results = {}
+        with ImageServer(image_path, latency) as server:
+            urls = ['{}/{}'.format(server.url, name) for name in names]
+
+            # a few popular images get most of the traffic
+            def make_request(i, n):
+                rng = random.Random(i * 1000003 + n)
+                picks = [urls[min(int(rng.expovariate(8. / len(urls))), len(urls) - 1)] for _ in range(batch)]
+                return json.dumps({ 'images': picks })
+
+            for mode in MODES:
+                # plain requests.get opens a new connection for every image
+                score.http = requests if mode == 'unpooled' else score.http_session(score.FETCH_WORKERS)
+                score.download_cache = score.LRUCache(score.FETCH_CACHE_BYTES if mode.endswith('cached') else 0,
+                                                      score.FETCH_CACHE_TTL)
+                score.prediction_cache = score.LRUCache(score.PREDICTION_CACHE_BYTES, score.PREDICTION_CACHE_TTL,
+                                                        score.PREDICTION_CACHE_ENTRIES) if mode == 'prediction_cache' else None
+                results[mode] = []
+                for c in concurrency:
+                    info('{} with {} concurrent clients'.format(mode, c))
+                    r = load(score.run, make_request, c, duration)
+                    r['download_cache'] = score.metrics()['download_cache']
+                    r['prediction_cache'] = score.metrics()['prediction_cache']
+                    results[mode].append(r)
+                    print('{throughput:.1f} req/s, p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms'.format(**r))
+
+        info('Results')
+        print('{:>16} {:>6} {:>10} {:>10} {:>10} {:>10}'.format('mode', 'conc', 'req/s', 'p50 ms', 'p99 ms', 'hit rate'))
+        for mode, rs in results.items():
+            for r in rs:
+                cache = r['prediction_cache'] or r['download_cache']
+                print('{:>16} {:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1%}'.format(mode, r['concurrency'], r['throughput'],
+                                                                              r['p50_ms'], r['p99_ms'], cache['hit_rate']))
+
+        if output:
+            write_results(output, 'fetch', results)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='score.run over a local image server with and without pooled connections, the download cache and the prediction cache')
+    parser.add_argument('-m', '--model_path', help='registered model folder (random weights if omitted)', default=None)
+    parser.add_argument('-w', '--work_path', help='scratch directory (temporary if omitted)', default=None)
+    parser.add_argument('-i', '--images', help='distinct images served', default=200, type=int)
+    parser.add_argument('-b', '--batch', help='images per request', default=8, type=int)
+    parser.add_argument('-c', '--concurrency', help='concurrent clients', default=[1, 8], type=int, nargs='+')
+    parser.add_argument('-d', '--duration', help='seconds per load level', default=10., type=float)
+    parser.add_argument('-l', '--latency', help='seconds the image server waits before every response', default=0.05, type=float)
+    parser.add_argument('-o', '--output', help='json result file', default=None)
+    args = parser.parse_args()
+
+    main(**vars(args))
@@ -0,0 +1,70 @@
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import prep
+import train
+from benchutils import info, synthetic_images, Timer, write_results
+
+def throughput(make_dataset, filenames, metadata, batch, steps):
+    img_shape = (metadata['image_size'], metadata['image_size'], 3)
+    ds = make_dataset(filenames, metadata.get('format', 'float'), metadata.get('compression', ''),
+                      img_shape, batch)
+
+    # first batch pays for the pipeline start up, leave it out
+    iterator = iter(ds)
+    next(iterator)
+    with Timer() as t:
+        for _ in range(steps):
+            next(iterator)
+    return (steps * batch) / t.elapsed
+
+def main(source_path, work_path, per_category, record_format, records, batch, steps, output):
+    cleanup = work_path is None
+    work_path = work_path or tempfile.mkdtemp(prefix='seer-bench-')
+    try:
+        target_path = os.path.join(work_path, 'prep')
+        if source_path is None or not os.path.exists(os.path.join(source_path, 'metadata.json')):
+            if source_path is None:
+                info('Generating synthetic images')
+                source_path = synthetic_images(os.path.join(work_path, 'raw'), per_category=per_category)
+            prep.main(source_path, target_path, records=records, image_size=160, force=True, workers=os.cpu_count(),
+                      seed=42, record_format=record_format, incremental=False)
+        else:
+            target_path = source_path
+
+        with open(os.path.join(target_path, 'metadata.json')) as f:
+            metadata = json.load(f)
+        filenames = [filename for filename, _ in train.load_records(target_path, metadata)]
+
+        results = {}
+        for name, make_dataset in train.PIPELINES.items():
+            info('Pipeline: {}'.format(name))
+            results[name] = { 'examples_per_sec': throughput(make_dataset, filenames, metadata, batch, steps) }
+            print('{:.1f} examples/sec'.format(results[name]['examples_per_sec']))
+
+        info('Results')
+        for name, r in results.items():
+            print('{:>8} {:>12.1f} examples/sec ({:.2f}x)'.format(name, r['examples_per_sec'],
+                                                                r['examples_per_sec'] / results['legacy']['examples_per_sec']))
+
+        if output:
+            write_results(output, 'input', results)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='training input pipeline throughput')
+    parser.add_argument('-s', '--source_path', help='raw images or prep output (synthetic if omitted)', default=None)
+    parser.add_argument('-w', '--work_path', help='scratch directory (temporary if omitted)', default=None)
+    parser.add_argument('-n', '--per_category', help='synthetic images per category', default=256, type=int)
+    parser.add_argument('-f', '--record_format', help='record format for synthetic data', default='uint8', choices=prep.RECORD_FORMATS)
+    parser.add_argument('-r', '--records', help='images per TFRecord', default=16, type=int)
+    parser.add_argument('-b', '--batch', help='batch size', default=32, type=int)
+    parser.add_argument('--steps', help='batches timed per pipeline', default=200, type=int)
+    parser.add_argument('-o', '--output', help='json result file', default=None)
+    args = parser.parse_args()
+
+    main(**vars(args))
@@ -0,0 +1,126 @@
+import os
+# the quantized artifacts are meant for CPU scoring containers
+os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+from benchutils import info, synthetic_images, bench_model, memory, percentiles, write_results
+
+ARTIFACTS = ['keras', 'dynamic', 'float16', 'int8']
+
+def held_out(prep_path, samples):
+    # the last test shard was never used for training or int8 calibration
+    import train
+    with open(os.path.join(prep_path, 'metadata.json')) as f:
+        prep = json.load(f)
+    _, test = train.split(train.load_records(prep_path, prep), train_files=prep.get('train_files'))
+    img_shape = (prep['image_size'], prep['image_size'], 3)
+    ds = train.fast_dataset([test[-1][0]], prep.get('format', 'float'), prep.get('compression', ''),
+                            img_shape, 1, epochs=1, training=False)
+    images, labels = [], []
+    for image, label in ds.take(samples):
+        images.append(image.numpy()[0])
+        labels.append(int(label.numpy()[0]))
+    return np.stack(images), np.array(labels)
+
+def measure(model_path, artifact, images_file, image_size):
+    # runs in a fresh process so memory belongs to this artifact alone
+    import score
+    images = np.load(images_file)
+    before = memory()
+    start = time.perf_counter()
+    _, artifact_path, _, infer = score.load_artifact(model_path, artifact, image_size)
+    load = time.perf_counter() - start
+    infer(images[:1])
+
+    preds, times = [], []
+    for image in images:
+        start = time.perf_counter()
+        pred = infer(image[np.newaxis])
+        times.append(time.perf_counter() - start)
+        preds.append(pred.numpy() if hasattr(pred, 'numpy') else pred)
+    after = memory()
+
+    result = dict((k + '_ms', v * 1000.) for k, v in percentiles(times).items())
+    result.update({
+        'file_mb': os.path.getsize(artifact_path) / (1024 * 1024),
+        'load_s': load,
+        'rss_mb': after['rss_mb'] - before['rss_mb'],
+        'peak_rss_mb': after['peak_rss_mb']
+    })
+    return result, np.concatenate(preds).argmax(axis=1).tolist()
+
+def main(model_path, source_path, work_path, per_category, samples, output):
+    import prep
+    import register
+
+    cleanup = work_path is None
+    work_path = work_path or tempfile.mkdtemp(prefix='seer-bench-')
+    try:
+        prep_path = os.path.join(work_path, 'prep')
+        if source_path is None:
+            info('Generating synthetic images')
+            source_path = synthetic_images(os.path.join(work_path, 'raw'), per_category=per_category)
+        prep.main(source_path, prep_path, records=16, image_size=160, force=True, workers=os.cpu_count(),
+                  seed=42, record_format='uint8', incremental=False)
+
+        # export into a scratch copy so a registered model folder is never touched
+        export_path = os.path.join(work_path, 'model')
+        if model_path is None:
+            info('Building random weight model')
+            bench_model(export_path)
+        else:
+            os.makedirs(export_path)
+            for name in ['model.hdf5', 'metadata.json']:
+                shutil.copy2(os.path.join(model_path, name), export_path)
+        with open(os.path.join(export_path, 'metadata.json')) as f:
+            image_size = json.load(f)['image_size']
+
+        info('Exporting tflite models')
+        register.export_tflite(os.path.join(export_path, 'model.hdf5'), export_path, prep_path)
+
+        images, labels = held_out(prep_path, samples)
+        images_file = os.path.join(work_path, 'held_out.npy')
+        np.save(images_file, images)
+        print('{} held out images'.format(len(images)))
+
+        results, top1 = {}, {}
+        context = multiprocessing.get_context('spawn')
+        for artifact in ARTIFACTS:
+            info('Artifact: {}'.format(artifact))
+            with context.Pool(1) as pool:
+                results[artifact], top1[artifact] = pool.apply(measure, (export_path, artifact, images_file, image_size))
+
+        for artifact in ARTIFACTS:
+            agree = np.array(top1[artifact]) == np.array(top1['keras'])
+            results[artifact]['top1_agreement'] = float(agree.mean())
+            results[artifact]['accuracy'] = float((np.array(top1[artifact]) == labels).mean())
+
+        info('Results')
+        print('{:>8} {:>9} {:>9} {:>9} {:>9} {:>10} {:>8}'.format('artifact', 'file MB', 'p50 ms', 'p99 ms', 'RSS MB', 'agreement', 'acc'))
+        for artifact, r in results.items():
+            print('{:>8} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.1f} {:>10.1%} {:>8.1%}'.format(
+                artifact, r['file_mb'], r['p50_ms'], r['p99_ms'], r['rss_mb'], r['top1_agreement'], r['accuracy']))
+
+        if output:
+            write_results(output, 'quantization', results)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='latency, memory and top-1 agreement of the quantized scoring artifacts')
+    parser.add_argument('-m', '--model_path', help='registered model folder (random weights if omitted)', default=None)
+    parser.add_argument('-s', '--source_path', help='directory to raw data (synthetic if omitted)', default=None)
+    parser.add_argument('-w', '--work_path', help='scratch directory (temporary if omitted)', default=None)
+    parser.add_argument('-n', '--per_category', help='synthetic images per category', default=64, type=int)
+    parser.add_argument('--samples', help='held out images to score', default=200, type=int)
+    parser.add_argument('-o', '--output', help='json result file', default=None)
+    args = parser.parse_args()
+
+    main(**vars(args))
@@ -0,0 +1,73 @@
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import tensorflow as tf
+import prep
+import train
+from benchutils import info, synthetic_images, dir_size, Timer, write_results
+
+def read_throughput(target_path, passes):
+    with open(os.path.join(target_path, 'metadata.json')) as f:
+        metadata = json.load(f)
+    record_format = metadata.get('format', 'float')
+    filenames = [filename for filename, _ in train.load_records(target_path, metadata)]
+
+    ds = tf.data.TFRecordDataset(filenames, compression_type=metadata.get('compression', '')) \
+            .map(lambda proto: train.parse_record(proto, record_format),
+                 num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    count = 0
+    with Timer() as t:
+        for _ in range(passes):
+            for image, label in ds:
+                count += 1
+    return count / t.elapsed
+
+def main(source_path, work_path, per_category, image_size, passes, output):
+    cleanup = work_path is None
+    work_path = work_path or tempfile.mkdtemp(prefix='seer-bench-')
+    try:
+        if source_path is None:
+            info('Generating synthetic images')
+            source_path = synthetic_images(os.path.join(work_path, 'raw'), per_category=per_category)
+
+        results = {}
+        for record_format in prep.RECORD_FORMATS:
+            info('Format: {}'.format(record_format))
+            target_path = os.path.join(work_path, record_format)
+            with Timer() as t:
+                prep.main(source_path, target_path, records=64, image_size=image_size, force=True,
+                          workers=1, seed=42, record_format=record_format, incremental=False)
+            size = dir_size(os.path.join(target_path, 'tfrecords'))
+            results[record_format] = {
+                'bytes': size,
+                'write_seconds': t.elapsed,
+                'examples_per_sec': read_throughput(target_path, passes)
+            }
+
+        info('Results')
+        base = results['float']['bytes']
+        print('{:>8} {:>14} {:>8} {:>14}'.format('format', 'bytes', 'ratio', 'examples/sec'))
+        for record_format, r in results.items():
+            print('{:>8} {:>14} {:>8.2f} {:>14.1f}'.format(record_format, r['bytes'],
+                                                           base / r['bytes'], r['examples_per_sec']))
+
+        if output:
+            write_results(output, 'records', results)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='record format size and read throughput comparison')
+    parser.add_argument('-s', '--source_path', help='directory to raw data (synthetic if omitted)', default=None)
+    parser.add_argument('-w', '--work_path', help='scratch directory (temporary if omitted)', default=None)
+    parser.add_argument('-n', '--per_category', help='synthetic images per category', default=128, type=int)
+    parser.add_argument('-i', '--image_size', help='resize height and width', default=160, type=int)
+    parser.add_argument('-p', '--passes', help='read passes over each dataset', default=3, type=int)
+    parser.add_argument('-o', '--output', help='json result file', default=None)
+    args = parser.parse_args()
+
+    main(**vars(args))
@@ -0,0 +1,60 @@
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import importlib
+from benchutils import info, synthetic_jpeg, bench_model, load, write_results
+
+def main(model_path, work_path, concurrency, duration, delay, output):
+    cleanup = work_path is None
+    work_path = work_path or tempfile.mkdtemp(prefix='seer-bench-')
+    try:
+        if model_path is None:
+            info('Building random weight model')
+            model_path = bench_model(os.path.join(work_path, 'model'))
+        image = synthetic_jpeg(os.path.join(work_path, 'image.jpg'))
+        request = json.dumps({ 'image': image })
+
+        results = {}
+        for mode in ['direct', 'micro_batch']:
+            # the batcher is configured at import time
+            os.environ['SEER_MICRO_BATCH'] = '1' if mode == 'micro_batch' else '0'
+            os.environ['SEER_MICRO_BATCH_DELAY_MS'] = str(delay)
+            import score
+            score = importlib.reload(score)
+            score.init(model_path)
+            score.run(request)
+
+            results[mode] = []
+            for c in concurrency:
+                info('{} with {} concurrent clients'.format(mode, c))
+                r = load(score.run, lambda i, n: request, c, duration)
+                r['metrics'] = score.metrics()['micro_batch']
+                results[mode].append(r)
+                print('{throughput:.1f} req/s, p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms'.format(**r))
+
+        info('Results')
+        print('{:>12} {:>6} {:>10} {:>10} {:>10}'.format('mode', 'conc', 'req/s', 'p50 ms', 'p99 ms'))
+        for mode, rs in results.items():
+            for r in rs:
+                print('{:>12} {:>6} {:>10.1f} {:>10.1f} {:>10.1f}'.format(mode, r['concurrency'], r['throughput'],
+                                                                        r['p50_ms'], r['p99_ms']))
+
+        if output:
+            write_results(output, 'score', results)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='score.run throughput with and without micro batching')
+    parser.add_argument('-m', '--model_path', help='registered model folder (random weights if omitted)', default=None)
+    parser.add_argument('-w', '--work_path', help='scratch directory (temporary if omitted)', default=None)
+    parser.add_argument('-c', '--concurrency', help='concurrent clients', default=[1, 4, 16, 32], type=int, nargs='+')
+    parser.add_argument('-d', '--duration', help='seconds per load level', default=10., type=float)
+    parser.add_argument('--delay', help='micro batch max delay in ms', default=5., type=float)
+    parser.add_argument('-o', '--output', help='json result file', default=None)
+    args = parser.parse_args()
+
+    main(**vars(args))
@@ -0,0 +1,73 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+import score
+from benchutils import info, bench_model, percentiles, write_results
+
+def latencies(fn, batch, calls):
+    times = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        fn(batch)
+        times.append(time.perf_counter() - start)
+    return times
+
+def main(model_path, work_path, batch_sizes, calls, output):
+    cleanup = work_path is None
+    work_path = work_path or tempfile.mkdtemp(prefix='seer-bench-')
+    try:
+        if model_path is None:
+            info('Building random weight model')
+            model_path = bench_model(os.path.join(work_path, 'model'))
+        model = tf.keras.models.load_model(os.path.join(model_path, 'model.hdf5'))
+        image_size = model.input_shape[1]
+
+        paths = {
+            'predict': lambda t: model.predict(t, steps=1),
+            'function': score.compile_model(model, image_size, False),
+            'function_xla': score.compile_model(model, image_size, True)
+        }
+
+        results = {}
+        for name, fn in paths.items():
+            results[name] = {}
+            for size in batch_sizes:
+                info('{} with batch {}'.format(name, size))
+                batch = tf.constant(np.random.rand(size, image_size, image_size, 3), dtype=tf.float32)
+                # the first call includes tracing (and XLA compilation)
+                start = time.perf_counter()
+                fn(batch)
+                first = time.perf_counter() - start
+                times = latencies(fn, batch, calls)
+                r = dict((k + '_ms', v * 1000.) for k, v in percentiles(times).items())
+                r['first_call_ms'] = first * 1000.
+                results[name][size] = r
+                print('first {first_call_ms:.1f}ms, p50 {p50_ms:.2f}ms, p99 {p99_ms:.2f}ms'.format(**r))
+
+        info('Results')
+        print('{:>14} {:>6} {:>12} {:>10} {:>10}'.format('path', 'batch', 'first ms', 'p50 ms', 'p99 ms'))
+        for name, sizes in results.items():
+            for size, r in sizes.items():
+                print('{:>14} {:>6} {:>12.1f} {:>10.2f} {:>10.2f}'.format(name, size, r['first_call_ms'],
+                                                                        r['p50_ms'], r['p99_ms']))
+
+        if output:
+            write_results(output, 'serving', results)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='per call latency of model.predict vs the compiled serving function')
+    parser.add_argument('-m', '--model_path', help='registered model folder (random weights if omitted)', default=None)
+    parser.add_argument('-w', '--work_path', help='scratch directory (temporary if omitted)', default=None)
+    parser.add_argument('-b', '--batch_sizes', help='batch sizes to time', default=[1, 8, 32], type=int, nargs='+')
+    parser.add_argument('-n', '--calls', help='timed calls per batch size', default=200, type=int)
+    parser.add_argument('-o', '--output', help='json result file', default=None)
+    args = parser.parse_args()
+
+    main(**vars(args))
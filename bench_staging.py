@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import prep
+import train
+from benchutils import info, synthetic_images, Timer, write_results
+
+def slow_copy(latency):
+    # stands in for a blob mount: every file open pays a round trip
+    def copy(source, target):
+        time.sleep(latency)
+        return shutil.copy2(source, target)
+    return copy
+
+def epoch_times(source_path, cache, cache_path, batch, epochs):
+    with open(os.path.join(source_path, 'metadata.json')) as f:
+        metadata = json.load(f)
+    records = train.load_records(source_path, metadata)
+    filenames = [filename for filename, _ in records]
+    steps = -(-sum(count for _, count in records) // batch)
+    img_shape = (metadata['image_size'], metadata['image_size'], 3)
+
+    train_cache, _ = train.cache_files(cache, cache_path, source_path, 'fast')
+    ds = train.fast_dataset(filenames, metadata.get('format', 'float'), metadata.get('compression', ''),
+                            img_shape, batch, epochs, cache=train_cache)
+    iterator = iter(ds)
+    times = []
+    for _ in range(epochs):
+        with Timer() as t:
+            for _ in range(steps):
+                next(iterator)
+        times.append(t.elapsed)
+    return times
+
+def main(source_path, work_path, per_category, latency, workers, batch, epochs, output):
+    cleanup = work_path is None
+    work_path = work_path or tempfile.mkdtemp(prefix='seer-bench-')
+    try:
+        remote_path = os.path.join(work_path, 'remote')
+        if source_path is None:
+            info('Generating synthetic images')
+            source_path = synthetic_images(os.path.join(work_path, 'raw'), per_category=per_category)
+        prep.main(source_path, remote_path, records=16, image_size=160, force=True, workers=os.cpu_count(),
+                  seed=42, record_format='uint8', incremental=False)
+
+        results = { 'staging': {}, 'epochs': {} }
+        for w in sorted(set([1, workers])):
+            info('Staging with {} worker(s), {}s latency per file'.format(w, latency))
+            local_path = os.path.join(work_path, 'local{}'.format(w))
+            results['staging'][w] = train.stage(remote_path, local_path, w, copy=slow_copy(latency))
+
+        local_path = os.path.join(work_path, 'local{}'.format(workers))
+        for cache in ['none', 'memory', 'disk']:
+            info('Epoch times with cache: {}'.format(cache))
+            times = epoch_times(local_path, cache, os.path.join(work_path, 'cache'), batch, epochs)
+            results['epochs'][cache] = times
+            print(', '.join('{:.2f}s'.format(t) for t in times))
+
+        if output:
+            write_results(output, 'staging', results)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='shard staging and decoded cache benchmark')
+    parser.add_argument('-s', '--source_path', help='directory to raw data (synthetic if omitted)', default=None)
+    parser.add_argument('-w', '--work_path', help='scratch directory (temporary if omitted)', default=None)
+    parser.add_argument('-n', '--per_category', help='synthetic images per category', default=256, type=int)
+    parser.add_argument('-l', '--latency', help='artificial seconds per file read', default=0.05, type=float)
+    parser.add_argument('--workers', help='parallel copies when staging', default=16, type=int)
+    parser.add_argument('-b', '--batch', help='batch size', default=32, type=int)
+    parser.add_argument('-e', '--epochs', help='epochs timed per cache mode', default=3, type=int)
+    parser.add_argument('-o', '--output', help='json result file', default=None)
+    args = parser.parse_args()
+
+    main(**vars(args))
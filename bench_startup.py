@@ -0,0 +1,93 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from benchutils import info, synthetic_jpeg, bench_model, write_results
+
+# a fresh interpreter per start, anything imported by this script would
+# already be loaded and hide its import cost
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import score
+imported = time.perf_counter()
+score.init(sys.argv[1])
+initialized = time.perf_counter()
+score.run(json.dumps({ 'image': sys.argv[2] }))
+done = time.perf_counter()
+print('STARTUP ' + json.dumps({
+    'import_s': imported - start,
+    'init_s': initialized - imported,
+    'load_s': score.startup['load_s'],
+    'warmup_s': score.startup['warmup_s'],
+    'first_request_s': done - initialized,
+    'artifact': score.startup['artifact']
+}))
+"""
+
+def start(model_path, image, artifact):
+    env = dict(os.environ, SEER_ARTIFACT=artifact, CUDA_VISIBLE_DEVICES='-1')
+    begin = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', CHILD, model_path, image], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    total = time.perf_counter() - begin
+    line = [l for l in out.stdout.splitlines() if l.startswith('STARTUP ')][-1]
+    result = json.loads(line[len('STARTUP '):])
+    result['total_s'] = total
+    return result
+
+def main(model_path, work_path, artifacts, repeat, output):
+    import register
+
+    cleanup = work_path is None
+    work_path = work_path or tempfile.mkdtemp(prefix='seer-bench-')
+    try:
+        # export into a scratch copy so a registered model folder is never touched
+        export_path = os.path.join(work_path, 'model')
+        if model_path is None:
+            info('Building random weight model')
+            bench_model(export_path)
+        else:
+            os.makedirs(export_path)
+            for name in ['model.hdf5', 'metadata.json']:
+                shutil.copy2(os.path.join(model_path, name), export_path)
+        register.export_saved_model(os.path.join(export_path, 'model.hdf5'), export_path)
+        if any(a not in ['keras', 'saved_model'] for a in artifacts):
+            register.export_tflite(os.path.join(export_path, 'model.hdf5'), export_path)
+        image = synthetic_jpeg(os.path.join(work_path, 'image.jpg'))
+
+        results = {}
+        keys = ['import_s', 'load_s', 'warmup_s', 'init_s', 'first_request_s', 'total_s']
+        for artifact in artifacts:
+            info('Starting {} x{}'.format(artifact, repeat))
+            runs = [start(export_path, image, artifact) for _ in range(repeat)]
+            results[artifact] = dict((k, float(np.median([r[k] for r in runs]))) for k in keys)
+            results[artifact]['runs'] = runs
+            print(', '.join('{} {:.2f}s'.format(k[:-2], results[artifact][k]) for k in keys))
+
+        info('Results (median seconds)')
+        print('{:>12}'.format('artifact') + ''.join('{:>14}'.format(k[:-2]) for k in keys))
+        for artifact, r in results.items():
+            print('{:>12}'.format(artifact) + ''.join('{:>14.2f}'.format(r[k]) for k in keys))
+
+        if output:
+            write_results(output, 'startup', results)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='scoring container start up: import, model load, warm up and first request')
+    parser.add_argument('-m', '--model_path', help='registered model folder (random weights if omitted)', default=None)
+    parser.add_argument('-w', '--work_path', help='scratch directory (temporary if omitted)', default=None)
+    parser.add_argument('-a', '--artifacts', help='artifacts to start from', default=['keras', 'saved_model', 'dynamic'], nargs='+')
+    parser.add_argument('-r', '--repeat', help='starts per artifact', default=3, type=int)
+    parser.add_argument('-o', '--output', help='json result file', default=None)
+    args = parser.parse_args()
+
+    main(**vars(args))
@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+import requests
+from benchutils import info, synthetic_jpeg, bench_model, load, process_memory, children, write_results
+from launch import free_port
+
+def total_memory(pid):
+    # the parent plus every worker, PSS counts the shared model pages once
+    pids = [pid] + children(pid)
+    usage = [process_memory(p) for p in pids]
+    return {
+        'processes': len(pids),
+        'rss_mb': sum(u.get('rss_mb', 0) for u in usage),
+        'pss_mb': sum(u.get('pss_mb', 0) for u in usage)
+    }
+
+def start(model_path, workers, artifact, threads, ready_path, log_file):
+    port = free_port()
+    command = [sys.executable, 'serve.py', '-m', model_path, '-p', str(port), '-w', str(workers),
+               '-a', artifact, '-r', ready_path]
+    if threads is not None:
+        command += ['-t', str(threads)]
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='-1')
+    process = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=log_file, stderr=subprocess.STDOUT)
+
+    # every worker drops a file once score.init has warmed up
+    deadline = time.time() + 600
+    ready = lambda: len(os.listdir(ready_path)) if os.path.exists(ready_path) else 0
+    while ready() < workers:
+        if process.poll() is not None:
+            raise RuntimeError('serve.py exited with {}, see {}'.format(process.returncode, log_file.name))
+        if time.time() > deadline:
+            process.kill()
+            raise RuntimeError('workers not ready after 600s, see {}'.format(log_file.name))
+        time.sleep(0.5)
+    return process, 'http://127.0.0.1:{}/score'.format(port)
+
+def main(model_path, work_path, workers, artifact, threads, clients, duration, output):
+    import register
+
+    cleanup = work_path is None
+    work_path = work_path or tempfile.mkdtemp(prefix='seer-bench-')
+    try:
+        # export into a scratch copy so a registered model folder is never touched
+        export_path = os.path.join(work_path, 'model')
+        if model_path is None:
+            info('Building random weight model')
+            bench_model(export_path)
+        else:
+            os.makedirs(export_path)
+            for name in ['model.hdf5', 'metadata.json']:
+                shutil.copy2(os.path.join(model_path, name), export_path)
+        if artifact == 'saved_model':
+            register.export_saved_model(os.path.join(export_path, 'model.hdf5'), export_path)
+        elif artifact != 'keras':
+            register.export_tflite(os.path.join(export_path, 'model.hdf5'), export_path)
+        image = synthetic_jpeg(os.path.join(work_path, 'image.jpg'))
+        request = json.dumps({ 'image': image })
+
+        # one keep-alive connection per client thread
+        local = threading.local()
+        def post(body):
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            response = local.session.post(url, data=body, headers={ 'Content-Type': 'application/json' })
+            response.raise_for_status()
+            return response
+
+        results = []
+        for w in workers:
+            info('{} workers ({})'.format(w, artifact))
+            ready_path = os.path.join(work_path, 'ready{}'.format(w))
+            with open(os.path.join(work_path, 'serve{}.log'.format(w)), 'w') as log_file:
+                process, url = start(export_path, w, artifact, threads, ready_path, log_file)
+                try:
+                    idle = total_memory(process.pid)
+                    c = clients or 2 * w
+                    r = load(post, lambda i, n: request, c, duration)
+                    loaded = total_memory(process.pid)
+                finally:
+                    process.send_signal(signal.SIGTERM)
+                    process.wait()
+
+            r.update({
+                'workers': w,
+                'idle_rss_mb': idle['rss_mb'],
+                'idle_pss_mb': idle['pss_mb'],
+                'rss_mb': loaded['rss_mb'],
+                'pss_mb': loaded['pss_mb']
+            })
+            results.append(r)
+            print('{throughput:.1f} req/s, p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms, RSS {rss_mb:.0f}MB, PSS {pss_mb:.0f}MB'.format(**r))
+
+        info('Results')
+        print('{:>8} {:>8} {:>10} {:>9} {:>9} {:>10} {:>10}'.format('workers', 'clients', 'req/s', 'p50 ms', 'p99 ms', 'RSS MB', 'PSS MB'))
+        for r in results:
+            print('{:>8} {:>8} {:>10.1f} {:>9.1f} {:>9.1f} {:>10.0f} {:>10.0f}'.format(r['workers'], r['concurrency'], r['throughput'],
+                                                                                r['p50_ms'], r['p99_ms'], r['rss_mb'], r['pss_mb']))
+
+        if output:
+            write_results(output, 'workers', results)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='serve.py throughput and memory as the number of workers grows')
+    parser.add_argument('-m', '--model_path', help='registered model folder (random weights if omitted)', default=None)
+    parser.add_argument('-w', '--work_path', help='scratch directory (temporary if omitted)', default=None)
+    parser.add_argument('-n', '--workers', help='worker counts to measure', default=[1, 2, 4], type=int, nargs='+')
+    parser.add_argument('-a', '--artifact', help='model artifact served', default='dynamic')
+    parser.add_argument('-t', '--threads', help='threads per worker (cores / workers if omitted)', default=None, type=int)
+    parser.add_argument('-c', '--clients', help='concurrent clients (twice the workers if omitted)', default=None, type=int)
+    parser.add_argument('-d', '--duration', help='seconds per worker count', default=20., type=float)
+    parser.add_argument('-o', '--output', help='json result file', default=None)
+    args = parser.parse_args()
+
+    main(**vars(args))
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+import tensorflow as tf
+from pathlib import Path
+from datetime import datetime
+
+def info(msg, char = "#", width = 75):
+    print("")
+    print(char * width)
+    print(char + "   %0*s" % ((-1*width)+5, msg) + char)
+    print(char * width)
+
+def synthetic_images(path, categories=2, per_category=64, height=480, width=640, seed=0):
+    # smooth random images so JPEG sizes look like photos instead of noise
+    tf.random.set_seed(seed)
+    for c in range(categories):
+        category = os.path.join(path, 'category{}'.format(c))
+        if not os.path.exists(category):
+            os.makedirs(category)
+        for i in range(per_category):
+            coarse = tf.random.uniform([height//40, width//40, 3], maxval=255)
+            img = tf.image.resize(coarse, [height, width], method='bicubic')
+            img = img + tf.random.normal([height, width, 3], stddev=8)
+            img = tf.cast(tf.clip_by_value(img, 0, 255), tf.uint8)
+            tf.io.write_file(os.path.join(category, 'img{:05d}.jpg'.format(i)),
+                             tf.io.encode_jpeg(img, quality=90))
+    return path
+
+def synthetic_jpeg(path, height=480, width=640, seed=0):
+    tf.random.set_seed(seed)
+    coarse = tf.random.uniform([max(height//40, 1), max(width//40, 1), 3], maxval=255)
+    img = tf.image.resize(coarse, [height, width], method='bicubic')
+    img = tf.cast(tf.clip_by_value(img, 0, 255), tf.uint8)
+    tf.io.write_file(path, tf.io.encode_jpeg(img, quality=90))
+    return path
+
+def bench_model(path, image_size=160, categories=2):
+    # same architecture train.py produces, random weights are fine for timing
+    if not os.path.exists(path):
+        os.makedirs(path)
+    base_model = tf.keras.applications.MobileNetV2(input_shape=(image_size, image_size, 3),
+                                                   include_top=False, weights=None, pooling='avg')
+    model = tf.keras.Sequential([base_model, tf.keras.layers.Dense(categories, activation='softmax')])
+    model.save(os.path.join(path, 'model.hdf5'))
+    names = ['category{}'.format(i) for i in range(categories)]
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        json.dump({
+            'image_size': image_size,
+            'categories': names,
+            'index': dict((n, i) for i, n in enumerate(names))
+        }, f)
+    return path
+
+class ImageServer(object):
+    """Serves a directory over http on localhost, every GET is delayed by
+    latency seconds to stand in for a remote image host."""
+
+    def __init__(self, root, latency=0.):
+        import http.server
+        import socketserver
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                # the base class maps urls below the working directory
+                relative = os.path.relpath(super().translate_path(path), os.getcwd())
+                return os.path.join(root, relative)
+
+            def do_GET(self):
+                time.sleep(latency)
+                super().do_GET()
+
+            def log_message(self, *args):
+                pass
+
+        class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+def load(fn, make_request, concurrency, duration, on_response=None):
+    # closed loop: every thread sends its next request as soon as the last
+    # one returns
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop = time.perf_counter() + duration
+
+    def worker(i):
+        n = 0
+        while time.perf_counter() < stop:
+            request = make_request(i, n)
+            start = time.perf_counter()
+            try:
+                response = fn(request)
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    if on_response is not None:
+                        on_response(request, response, elapsed)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+            n += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    result = { 'concurrency': concurrency }
+    result.update(summarize(latencies, errors[0], elapsed))
+    return result
+
+def open_loop(fn, make_request, rate, duration, max_workers=256, seed=0, on_response=None):
+    # requests arrive as a Poisson process whether or not earlier ones have
+    # returned, latency counts from the scheduled arrival so time spent
+    # waiting for a free worker is not hidden
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+    latencies, errors, late = [], [0], [0]
+    lock = threading.Lock()
+    rng = random.Random(seed)
+
+    def send(request, arrival):
+        try:
+            response = fn(request)
+            elapsed = time.perf_counter() - arrival
+            with lock:
+                latencies.append(elapsed)
+                if on_response is not None:
+                    on_response(request, response, elapsed)
+        except Exception:
+            with lock:
+                errors[0] += 1
+
+    start = time.perf_counter()
+    arrival, n = start, 0
+    with ThreadPoolExecutor(max_workers) as pool:
+        while True:
+            arrival += rng.expovariate(rate)
+            if arrival - start >= duration:
+                break
+            wait = arrival - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                late[0] += 1
+            pool.submit(send, make_request(0, n), arrival)
+            n += 1
+    elapsed = time.perf_counter() - start
+
+    result = { 'rate': rate, 'sent': n, 'late_sends': late[0] }
+    result.update(summarize(latencies, errors[0], elapsed))
+    return result
+
+def summarize(latencies, errors, elapsed):
+    result = {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed
+    }
+    result.update(dict((k + '_ms', v * 1000. if v is not None else None) for k, v in percentiles(latencies).items()))
+    return result
+
+def memory():
+    # resident and peak resident set of this process in MB
+    usage = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ['VmRSS', 'VmHWM']:
+                    usage['rss_mb' if key == 'VmRSS' else 'peak_rss_mb'] = int(value.split()[0]) / 1024.
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        usage = { 'rss_mb': peak, 'peak_rss_mb': peak }
+    return usage
+
+def process_memory(pid):
+    # resident and proportional set size in MB, PSS splits shared pages
+    # (mapped model files, shared libraries) between the processes using them
+    usage = {}
+    for name in ['smaps_rollup', 'status']:
+        try:
+            with open('/proc/{}/{}'.format(pid, name)) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in ['Rss', 'VmRSS']:
+                        usage.setdefault('rss_mb', int(value.split()[0]) / 1024.)
+                    elif key == 'Pss':
+                        usage['pss_mb'] = int(value.split()[0]) / 1024.
+        except OSError:
+            continue
+    return usage
+
+def children(pid):
+    pids = []
+    for stat in Path('/proc').glob('[0-9]*/stat'):
+        try:
+            fields = stat.read_text().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(stat.parent.name))
+    return pids
+
+def reset_peak():
+    # Linux resets VmHWM to the current RSS when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def dir_size(path):
+    return sum(p.stat().st_size for p in Path(path).rglob('*') if p.is_file())
+
+def percentiles(values, ps=[50, 95, 99]):
+    if len(values) == 0:
+        return dict(('p{}'.format(p), None) for p in ps)
+    return dict(('p{}'.format(p), float(np.percentile(values, p))) for p in ps)
+
+class Timer(object):
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+
+def write_results(path, name, results):
+    output = {
+        'benchmark': name,
+        'generated': datetime.now().strftime('%m/%d/%y %H:%M:%S'),
+        'results': results
+    }
+    print('Writing results to {}'.format(path))
+    with open(str(path), 'w') as f:
+        json.dump(output, f, indent=2)
+    return output
@@ -0,0 +1,40 @@
+import os
+import sys
+import json
+import socket
+import argparse
+import subprocess
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def main(workers, cpu, script):
+    # local stand in for the cluster AML provisions: one process per
+    # worker, all on localhost, each with its own TF_CONFIG
+    cluster = { 'worker': ['localhost:{}'.format(free_port()) for _ in range(workers)] }
+    print('Cluster: {}'.format(cluster))
+
+    processes = []
+    for i in range(workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({ 'cluster': cluster, 'task': { 'type': 'worker', 'index': i } })
+        if cpu:
+            env['CUDA_VISIBLE_DEVICES'] = '-1'
+        print('Starting worker {}: {}'.format(i, ' '.join(script)))
+        processes.append(subprocess.Popen([sys.executable] + script, env=env))
+
+    codes = [p.wait() for p in processes]
+    for i, code in enumerate(codes):
+        print('Worker {} exited with {}'.format(i, code))
+    return max(codes, key=abs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='run a multi worker script as local processes')
+    parser.add_argument('-n', '--workers', help='number of local workers', default=2, type=int)
+    parser.add_argument('-c', '--cpu', help='hide GPUs from the workers', default=False, action='store_true')
+    parser.add_argument('script', help='script and its arguments, i.e. train.py -s data/prep -t data/train -d', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    sys.exit(main(**vars(args)))
@@ -0,0 +1,197 @@
+import os
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import collections
+from pathlib import Path
+from benchutils import info, synthetic_jpeg, bench_model, load, open_loop, percentiles, ImageServer, write_results
+
+SOURCES = ['local', 'http']
+IMAGE_TYPES = ['*.jpg', '*.jpeg', '*.png']
+
+def weights(items, cast=str):
+    # ['local=3', 'http=1'] => {'local': 3., 'http': 1.}
+    parsed = collections.OrderedDict()
+    for item in items:
+        name, _, weight = item.partition('=')
+        parsed[cast(name)] = float(weight) if weight else 1.
+    return parsed
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Stages(object):
+    """Per stage latencies from the 'timing' score.run puts in every
+    response, plus whatever the client saw on top of the server total."""
+
+    def __init__(self):
+        self.values = collections.defaultdict(list)
+        self.images = collections.Counter()
+
+    def __call__(self, request, response, elapsed):
+        if isinstance(response, str):
+            response = json.loads(response)
+        timing = response.get('timing', {})
+        for k, v in timing.items():
+            self.values[k].append(v)
+        if 'total_ms' in timing:
+            self.values['client_overhead_ms'].append(elapsed * 1000. - timing['total_ms'])
+        for result in response.get('results', [response]):
+            self.images['failed' if 'error' in result else result.get('cached', 'scored')] += 1
+
+    def summary(self):
+        summary = dict((k, dict((p + '_ms', v) for p, v in percentiles(vs).items())) for k, vs in self.values.items())
+        summary['images'] = dict(self.images)
+        return summary
+
+def main(model_path, url, work_path, image_path, images, mix, batch_sizes, latency, concurrency, rates,
+         duration, warmup, label, baseline, seed, output):
+    cleanup = work_path is None
+    work_path = work_path or tempfile.mkdtemp(prefix='seer-load-')
+    try:
+        sources = weights(mix)
+        sizes = weights(batch_sizes, int)
+        unknown = [s for s in sources if s not in SOURCES]
+        if len(unknown) > 0:
+            raise ValueError('Unknown request sources {}, expected {}'.format(unknown, SOURCES))
+
+        if image_path is None:
+            info('Generating {} images'.format(images))
+            image_path = os.path.join(work_path, 'images')
+            os.makedirs(image_path)
+            for i in range(images):
+                synthetic_jpeg(os.path.join(image_path, 'img{:05d}.jpg'.format(i)), seed=i)
+        files = sorted(str(p.resolve()) for t in IMAGE_TYPES for p in Path(image_path).glob(t))
+        if len(files) == 0:
+            raise ValueError('No images found in {}'.format(image_path))
+        print('{} images in {}'.format(len(files), image_path))
+
+        if url is None:
+            # in process, straight through score.init/score.run
+            import score
+            if model_path is None:
+                info('Building random weight model')
+                model_path = bench_model(os.path.join(work_path, 'model'))
+            score.init(model_path)
+            target, fn = 'score.run', score.run
+        else:
+            import requests
+            session = requests.Session()
+            def fn(body):
+                response = session.post(url, data=body, headers={ 'Content-Type': 'application/json' })
+                response.raise_for_status()
+                return response.json()
+            target = url
+
+        with ImageServer(os.path.dirname(files[0]), latency) as server:
+            def image(rng):
+                source = rng.choices(list(sources), list(sources.values()))[0]
+                path = rng.choice(files)
+                return path if source == 'local' else '{}/{}'.format(server.url, os.path.basename(path))
+
+            def make_request(i, n):
+                rng = random.Random('{}-{}-{}'.format(seed, i, n))
+                size = rng.choices(list(sizes), list(sizes.values()))[0]
+                if size == 1:
+                    return json.dumps({ 'image': image(rng) })
+                return json.dumps({ 'images': [image(rng) for _ in range(size)] })
+
+            if warmup > 0:
+                info('Warm up for {}s'.format(warmup))
+                load(fn, make_request, 1, warmup)
+
+            levels = [('concurrency', c) for c in concurrency] + [('rate', r) for r in rates]
+            results = []
+            for kind, level in levels:
+                info('{} {} for {}s'.format(kind, level, duration))
+                stages = Stages()
+                if kind == 'concurrency':
+                    r = load(fn, make_request, level, duration, on_response=stages)
+                else:
+                    r = open_loop(fn, make_request, level, duration, seed=seed, on_response=stages)
+                r['stages'] = stages.summary()
+                results.append(r)
+                print('{throughput:.1f} req/s, p50 {p50_ms:.1f}ms, p95 {p95_ms:.1f}ms, p99 {p99_ms:.1f}ms, {errors} errors'.format(**r))
+                for k, v in r['stages'].items():
+                    if k != 'images':
+                        print('   {:<20} p50 {:>8.1f}ms  p99 {:>8.1f}ms'.format(k, v['p50_ms'] or 0, v['p99_ms'] or 0))
+
+        summary = {
+            'label': label,
+            'revision': revision(),
+            'target': target,
+            'model_path': model_path,
+            'mix': sources,
+            'batch_sizes': dict((str(k), v) for k, v in sizes.items()),
+            'image_latency_s': latency,
+            'duration_s': duration,
+            'levels': results
+        }
+        if url is None:
+            summary['metrics'] = score.metrics()
+
+        info('Results')
+        print('{:>12} {:>8} {:>10} {:>9} {:>9} {:>9} {:>7}'.format('level', 'value', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+        for r in results:
+            kind = 'concurrency' if 'concurrency' in r else 'rate'
+            print('{:>12} {:>8} {:>10.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>7}'.format(kind, r[kind], r['throughput'],
+                  r['p50_ms'] or 0, r['p95_ms'] or 0, r['p99_ms'] or 0, r['errors']))
+
+        if baseline is not None:
+            compare(baseline, results)
+
+        if output:
+            write_results(output, 'loadtest', summary)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+def compare(baseline, results):
+    with open(baseline) as f:
+        base = json.load(f)['results']
+    info('Compared to {} ({})'.format(base.get('label') or baseline, base.get('revision')))
+    previous = dict((('concurrency', r['concurrency']) if 'concurrency' in r else ('rate', r['rate']), r) for r in base['levels'])
+    for r in results:
+        level = ('concurrency', r['concurrency']) if 'concurrency' in r else ('rate', r['rate'])
+        if level not in previous:
+            continue
+        b = previous[level]
+        ratio = lambda k: r[k] / b[k] if b.get(k) and r.get(k) is not None else float('nan')
+        print('{:>12} {:>8}: throughput x{:.2f}, p50 x{:.2f}, p99 x{:.2f}'.format(level[0], level[1], ratio('throughput'),
+                                                                              ratio('p50_ms'), ratio('p99_ms')))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='load test score.run in process or a scoring endpoint over http')
+    parser.add_argument('-m', '--model_path', help='registered model folder for in process runs (random weights if omitted)', default=None)
+    parser.add_argument('-u', '--url', help='scoring endpoint to post to instead of calling score.run in process', default=None)
+    parser.add_argument('-w', '--work_path', help='scratch directory (temporary if omitted)', default=None)
+    parser.add_argument('-i', '--image_path', help='directory of images to send (synthetic if omitted)', default=None)
+    parser.add_argument('-n', '--images', help='synthetic images to generate', default=100, type=int)
+    parser.add_argument('--mix', help='image sources and weights, local=file paths, http=local image server', default=['local=1', 'http=1'], nargs='+')
+    parser.add_argument('-b', '--batch_sizes', help='images per request and weights, e.g. 1=4 8=1', default=['1'], nargs='+')
+    parser.add_argument('-l', '--latency', help='seconds the local image server waits before every response', default=0., type=float)
+    parser.add_argument('-c', '--concurrency', help='closed loop client counts', default=[], type=int, nargs='*')
+    parser.add_argument('-r', '--rates', help='open loop arrival rates in requests per second', default=[], type=float, nargs='*')
+    parser.add_argument('-d', '--duration', help='seconds per level', default=30., type=float)
+    parser.add_argument('--warmup', help='seconds of untimed requests before the first level', default=5., type=float)
+    parser.add_argument('--label', help='name for this run in the result file, e.g. a model version', default=None)
+    parser.add_argument('--baseline', help='earlier result file to compare against', default=None)
+    parser.add_argument('--seed', help='request mix seed', default=0, type=int)
+    parser.add_argument('-o', '--output', help='json result file', default='loadtest.json')
+    args = parser.parse_args()
+
+    if len(args.concurrency) == 0 and len(args.rates) == 0:
+        args.concurrency = [1, 4, 16]
+
+    params = vars(args)
+    for i in params:
+        print('{} => {}'.format(i, params[i]))
+
+    main(**params)
@@ -6,6 +6,7 @@ from azureml.core import Workspace, Experiment, Datastore
 from azureml.data.datapath import DataPath, DataPathComputeBinding
 from azureml.data.data_reference import DataReference
 from azureml.core.compute import ComputeTarget, AmlCompute
+from azureml.core.runconfig import TensorflowConfiguration
 from azureml.core.authentication import ServicePrincipalAuthentication
 from azureml.pipeline.core import Pipeline, PipelineData, PipelineParameter, PublishedPipeline, PipelineEndpoint
 from azureml.pipeline.steps import PythonScriptStep, EstimatorStep
@@ -49,7 +50,7 @@ def get_compute(ws: Workspace, compute_target: str) -> ComputeTarget:
 ##############################################################
 
 # data process step
-def process_step(datastore: Datastore, compute: ComputeTarget, path_on_datastore: str) -> (PipelineData, EstimatorStep):
+def process_step(datastore: Datastore, compute: ComputeTarget, path_on_datastore: str, nodes: int = 1) -> (PipelineData, EstimatorStep):
     datapath = DataPath(datastore=datastore, path_on_datastore=path_on_datastore)
     data_path_pipeline_param = (PipelineParameter(name="data", default_value=datapath), DataPathComputeBinding(mode='mount'))
 
@@ -65,30 +66,79 @@ def process_step(datastore: Datastore, compute: ComputeTarget, path_on_datastore
                         use_gpu=True,
                         pip_requirements_file='requirements.txt')
 
-    prepStep = EstimatorStep(
-        name='Data Preparation',
+    if nodes <= 1:
+        prepStep = EstimatorStep(
+            name='Data Preparation',
+            estimator=prep,
+            estimator_entry_script_arguments=["--source_path", data_path_pipeline_param, 
+                                              "--target_path", seer_tfrecords,
+                                              "--workers", 6],
+            inputs=[data_path_pipeline_param],
+            outputs=[seer_tfrecords],
+            compute_target=compute
+        )
+
+        return seer_tfrecords, prepStep
+
+    # one step per node, each converting a disjoint slice of the images
+    slices = []
+    for i in range(nodes):
+        seer_slice = PipelineData(
+            "tfrecords_slice{}".format(i),
+            datastore=datastore,
+            is_directory=True
+        )
+
+        EstimatorStep(
+            name='Data Preparation {} of {}'.format(i + 1, nodes),
+            estimator=prep,
+            estimator_entry_script_arguments=["--source_path", data_path_pipeline_param, 
+                                              "--target_path", seer_slice,
+                                              "--workers", 6,
+                                              "--shard_index", i,
+                                              "--shard_count", nodes],
+            inputs=[data_path_pipeline_param],
+            outputs=[seer_slice],
+            compute_target=compute
+        )
+        slices.append(seer_slice)
+
+    # the pipeline picks up the slice steps through their outputs
+    mergeStep = EstimatorStep(
+        name='Data Preparation Merge',
         estimator=prep,
-        estimator_entry_script_arguments=["--source_path", data_path_pipeline_param, 
-                                          "--target_path", seer_tfrecords],
-        inputs=[data_path_pipeline_param],
+        estimator_entry_script_arguments=["--target_path", seer_tfrecords,
+                                          "--merge"] + slices,
+        inputs=slices,
         outputs=[seer_tfrecords],
         compute_target=compute
     )
 
-    return seer_tfrecords, prepStep
+    return seer_tfrecords, mergeStep
 
-def train_step(datastore: Datastore, input_data: PipelineData, compute: ComputeTarget) -> (PipelineData, EstimatorStep):
+def train_step(datastore: Datastore, input_data: PipelineData, compute: ComputeTarget, nodes: int = 1) -> (PipelineData, EstimatorStep):
     seer_training = PipelineData(
         "train",
         datastore=datastore,
         is_directory=True
     )
 
+    # AML fills in TF_CONFIG for every node, train.py shards by worker
+    distributed = {}
+    arguments = []
+    if nodes > 1:
+        distributed = {
+            'node_count': nodes,
+            'distributed_training': TensorflowConfiguration(worker_count=nodes, parameter_server_count=0)
+        }
+        arguments = ["--distributed"]
+
     train = TensorFlow(source_directory='.',
                         compute_target=compute,
                         entry_script='train.py',
                         use_gpu=True,
-                        pip_requirements_file='requirements.txt')
+                        pip_requirements_file='requirements.txt',
+                        **distributed)
 
     trainStep = EstimatorStep(
         name='Model Training',
@@ -97,7 +147,7 @@ def train_step(datastore: Datastore, input_data: PipelineData, compute: ComputeT
                                         "--target_path", seer_training,
                                         "--epochs", 15,
                                         "--batch", 10,
-                                        "--lr", 0.001],
+                                        "--lr", 0.001] + arguments,
         inputs=[input_data],
         outputs=[seer_training],
         compute_target=compute
@@ -105,24 +155,63 @@ def train_step(datastore: Datastore, input_data: PipelineData, compute: ComputeT
 
     return seer_training, trainStep
 
-def register_step(datastore: Datastore, input_data: PipelineData, compute: ComputeTarget, build: str) -> (PipelineData, EstimatorStep):
+def sweep_step(datastore: Datastore, input_data: PipelineData, compute: ComputeTarget, trials: int) -> (PipelineData, EstimatorStep):
+    seer_sweep = PipelineData(
+        "sweep",
+        datastore=datastore,
+        is_directory=True
+    )
+
+    sweep = TensorFlow(source_directory='.',
+                        compute_target=compute,
+                        entry_script='sweep.py',
+                        use_gpu=True,
+                        pip_requirements_file='requirements.txt')
+
+    sweepStep = EstimatorStep(
+        name='Hyperparameter Sweep',
+        estimator=sweep,
+        estimator_entry_script_arguments=["--source_path", input_data, 
+                                        "--target_path", seer_sweep,
+                                        "--trials", trials,
+                                        "--max_epochs", 15,
+                                        "--stage_path", "/tmp/seer-prep"],
+        inputs=[input_data],
+        outputs=[seer_sweep],
+        compute_target=compute
+    )
+
+    return seer_sweep, sweepStep
+
+def register_step(datastore: Datastore, input_data: PipelineData, compute: ComputeTarget, build: str, leaderboard: bool = False, calibration_data: PipelineData = None) -> (PipelineData, EstimatorStep):
     seer_model = PipelineData(
         "model",
         datastore=datastore,
         is_directory=True
     )
 
-    register = Estimator(source_directory='.',
-                        compute_target=compute,
-                        entry_script='register.py')
+    # serving exports need tensorflow and the prep output for calibration
+    arguments = ["--leaderboard"] if leaderboard else []
+    inputs = [input_data]
+    if calibration_data is not None:
+        arguments += ["--saved_model", "--quantize", "--data_path", calibration_data]
+        inputs.append(calibration_data)
+        register = TensorFlow(source_directory='.',
+                            compute_target=compute,
+                            entry_script='register.py',
+                            pip_requirements_file='requirements.txt')
+    else:
+        register = Estimator(source_directory='.',
+                            compute_target=compute,
+                            entry_script='register.py')
 
     registerStep = EstimatorStep(
         name='Model Registration',
         estimator=register,
         estimator_entry_script_arguments=["--source_path", input_data, 
                                           "--target_path", seer_model,
-                                          "--build", build],
-        inputs=[input_data],
+                                          "--build", build] + arguments,
+        inputs=inputs,
         outputs=[seer_model],
         compute_target=compute
     )
@@ -185,6 +274,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Seer Pipeline')
     parser.add_argument('-a', '--arguments', help='json file with arguments')
     parser.add_argument('-b', '--build', help='build number')
+    parser.add_argument('-p', '--prep_nodes', help='nodes converting images in parallel', default=1, type=int)
+    parser.add_argument('-n', '--train_nodes', help='nodes training in parallel', default=1, type=int)
+    parser.add_argument('-w', '--sweep', help='hyperparameter trials instead of a single training run', default=0, type=int)
 
 
     args = parser.parse_args()
@@ -203,13 +295,16 @@ if __name__ == "__main__":
     compute = get_compute(ws, secrets["compute_target"])
 
     # prep step
-    pdata, pstep = process_step(datastore, compute, secrets["datastore_path"])
+    pdata, pstep = process_step(datastore, compute, secrets["datastore_path"], args.prep_nodes)
 
-    # train step
-    tdata, tstep = train_step(datastore, pdata, compute)
+    # train step (or a sweep over many)
+    if args.sweep > 0:
+        tdata, tstep = sweep_step(datastore, pdata, compute, args.sweep)
+    else:
+        tdata, tstep = train_step(datastore, pdata, compute, args.train_nodes)
 
     # register step (tag model with version)
-    rdata, rstep = register_step(datastore, tdata, compute, args.build)
+    rdata, rstep = register_step(datastore, tdata, compute, args.build, args.sweep > 0, pdata)
 
     # create pipeline from steps
     seer_pipeline = Pipeline(workspace=ws, steps=[pstep, tstep, rstep])
@@ -2,11 +2,20 @@ import os
 import csv
 import json
 import shutil
+import zlib
 import random
+import hashlib
 import argparse
+import itertools
+import collections
+import multiprocessing
+import multiprocessing.pool
 import tensorflow as tf
+from PIL import Image
 from pathlib import Path
 from datetime import datetime
+# same decode and resize the scoring endpoint applies to requests
+from score import resize_image
 
 def _float_feature(value):
     """Returns a float_list from a float / double."""
@@ -21,22 +30,48 @@ def _floats_feature(value):
         value = value.numpy() # BytesList won't unpack a string from an EagerTensor.
     return tf.train.Feature(float_list=tf.train.FloatList(value=value.reshape(-1)))
 
+def _bytes_feature(value):
+    """Returns a bytes_list from a string / byte."""
+    if isinstance(value, type(tf.constant(0))):
+        value = value.numpy() # BytesList won't unpack a string from an EagerTensor.
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+# version 1 datasets have no 'format' entry in metadata.json and are 'float',
+# version 2 decoded with tensorflow and ignored EXIF orientation
+RECORD_FORMAT_VERSION = 3
+RECORD_FORMATS = ['float', 'uint8', 'jpeg', 'png']
+# train/test share of the shards, same default as train.split
+SPLIT = [8, 2]
+
 def info(msg, char = "#", width = 75):
     print("")
     print(char * width)
     print(char + "   %0*s" % ((-1*width)+5, msg) + char)
     print(char * width)
 
-def example(base_path, rel_path, labelidx, image_size=160):
+def encode(img_resized, record_format):
+    if record_format == 'float':
+        return _floats_feature(img_resized / 255)
+
+    img_uint8 = tf.cast(tf.clip_by_value(tf.round(img_resized), 0, 255), tf.uint8)
+    if record_format == 'uint8':
+        return _bytes_feature(img_uint8.numpy().tobytes())
+    elif record_format == 'jpeg':
+        return _bytes_feature(tf.io.encode_jpeg(img_uint8, quality=95))
+    elif record_format == 'png':
+        return _bytes_feature(tf.io.encode_png(img_uint8))
+    else:
+        raise ValueError('Unknown record format "{}"'.format(record_format))
+
+def example(base_path, rel_path, labelidx, image_size=160, record_format='float'):
     # get path
     image_path = os.path.join(base_path, rel_path)
     
     # load bits and resize
-    img_raw = tf.io.read_file(image_path)
-    img_tensor = tf.image.decode_jpeg(img_raw, channels=3)
-    img_final = tf.image.resize(img_tensor, [image_size, image_size]) / 255
+    with Image.open(image_path) as img:
+        img_resized = tf.convert_to_tensor(resize_image(img, image_size), dtype=tf.float32)
     
-    img_shape = img_final.shape
+    img_shape = img_resized.shape
     assert img_shape[2] == 3, "Invalid channel count"
     
     # feature descriptions
@@ -45,14 +80,209 @@ def example(base_path, rel_path, labelidx, image_size=160):
         'width': _int64_feature(img_shape[1]),
         'depth': _int64_feature(img_shape[2]),
         'label': _int64_feature(int(labelidx)),
-        'image': _floats_feature(img_final),
+        'image': encode(img_resized, record_format),
     }
     
     example = tf.train.Example(features=tf.train.Features(feature=feature))
     
     return example
 
-def main(source_path, target_path, records, image_size, force):
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def describe(source_path, rel_path, content_hash=True):
+    path = os.path.join(source_path, rel_path)
+    stat = os.stat(path)
+    desc = { 'size': stat.st_size, 'mtime': stat.st_mtime }
+    if content_hash:
+        desc['sha1'] = file_hash(path)
+    return desc
+
+def init_worker():
+    # one image at a time per process, let the pool provide the parallelism
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def write_shard(task):
+    source_path, tfrecord, rows, image_size, record_format, compression, content_hash = task
+    # manifest entries for every source, 'shard' stays None on failure
+    sources = {}
+    with tf.io.TFRecordWriter(tfrecord, tf.io.TFRecordOptions(compression_type=compression)) as writer:
+        for rel_path, _, labelidx in rows:
+            try:
+                sources[rel_path] = describe(source_path, rel_path, content_hash)
+                sources[rel_path]['shard'] = None
+                image = example(source_path, rel_path, labelidx, image_size, record_format)
+                writer.write(image.SerializeToString())
+                sources[rel_path]['shard'] = tfrecord
+            except Exception as e:
+                print('Error: {} ({})'.format(rel_path, e))
+    return tfrecord, sources
+
+def scan(source_path, categories, index):
+    # round robin over the category folders so the stream is class mixed
+    # from the first record instead of one category after another
+    folders = collections.deque((c, os.scandir(os.path.join(source_path, c))) for c in categories)
+    while len(folders) > 0:
+        category, entries = folders.popleft()
+        entry = next(entries, None)
+        if entry is None:
+            entries.close()
+            continue
+        folders.append((category, entries))
+        if entry.is_file():
+            yield [os.path.join(category, entry.name), category, index[category]]
+
+def shuffle_buffer(rows, size, rng):
+    # bounded memory shuffle, same idea as tf.data.Dataset.shuffle
+    buffer = []
+    for row in rows:
+        if len(buffer) < size:
+            buffer.append(row)
+        else:
+            i = rng.randrange(size)
+            yield buffer[i]
+            buffer[i] = row
+    rng.shuffle(buffer)
+    for row in buffer:
+        yield row
+
+def records_per_shard(source_path, sample, image_size, record_format, shard_mb, records):
+    # serialized size of a few images is a good enough guess for the rest
+    sizes = []
+    for rel_path, _, labelidx in sample:
+        try:
+            sizes.append(len(example(source_path, rel_path, labelidx, image_size, record_format).SerializeToString()))
+        except Exception as e:
+            print('Error: {} ({})'.format(rel_path, e))
+
+    if len(sizes) == 0:
+        print('Could not estimate the record size, using {} records per shard'.format(records))
+        return records
+
+    average = sum(sizes) / len(sizes)
+    records = max(1, int(shard_mb * 1024 * 1024 // average))
+    print('Average record is {:.1f} KB, {} records per {} MB shard'.format(average / 1024, records, shard_mb))
+    return records
+
+def node_slice(images, shard_index, shard_count):
+    # stable hash of the relative path so every node agrees on the split
+    # regardless of listing order, seed or operating system
+    for row in images:
+        if zlib.crc32(row[0].replace(os.sep, '/').encode('utf-8')) % shard_count == shard_index:
+            yield row
+
+def shard_tasks(source_path, write_path, images, records, image_size, record_format, compression='', start=0, prefix='',
+                content_hash=False):
+    record_file = os.path.join(write_path, '{}.tfrecords')
+    images = iter(images)
+    for i in itertools.count(start):
+        rows = list(itertools.islice(images, records))
+        if len(rows) == 0:
+            break
+        tfrecord = record_file.format('{}images{}_{}'.format(prefix, i, records))
+        yield (source_path, tfrecord, rows, image_size, record_format, compression, content_hash)
+
+def process(tasks, workers):
+    # shards come back in submission order so the listing is deterministic
+    if workers <= 1:
+        for task in tasks:
+            yield write_shard(task)
+    else:
+        # keep only a couple of shards in flight per worker so a streaming
+        # scan never gets buffered in full ahead of the pool
+        pool = multiprocessing.get_context('spawn').Pool(workers, initializer=init_worker)
+        pending = collections.deque()
+        try:
+            for task in tasks:
+                pending.append(pool.apply_async(write_shard, (task,)))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().get()
+            while len(pending) > 0:
+                yield pending.popleft().get()
+        finally:
+            pool.close()
+            pool.join()
+
+def load_manifest(manifest_file, settings):
+    if not os.path.exists(manifest_file):
+        print('No manifest at {}, processing everything'.format(manifest_file))
+        return None
+
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+
+    if manifest['settings'] != settings:
+        print('Manifest settings {} differ from {}, processing everything'.format(manifest['settings'], settings))
+        return None
+
+    return manifest
+
+def assign_splits(kept, written, split=SPLIT):
+    """Train or test side for each shard written this run."""
+    # kept shards never switch sides, new ones top up the test share and
+    # train otherwise (a full run ends up with the last shards as test,
+    # same as cutting the listing by position)
+    total = len(kept) + len(written)
+    tests = total - int(total * (split[0] / sum(split)))
+    tests -= len([shard for shard in kept.values() if shard['split'] == 'test'])
+    tests = min(max(tests, 0), len(written))
+    return dict((shard, 'test' if i >= len(written) - tests else 'train') for i, shard in enumerate(written))
+
+def plan(source_path, images, manifest):
+    """Split images into kept shards and images that need (re)processing."""
+    current = set(row[0] for row in images)
+    stale = set()
+    touched = {}
+
+    # deleted sources invalidate the shard holding their record
+    for rel_path, prev in manifest['sources'].items():
+        if rel_path not in current:
+            print('Deleted: {}'.format(rel_path))
+            stale.add(prev['shard'])
+
+    todo = set()
+    for rel_path in current:
+        prev = manifest['sources'].get(rel_path)
+        if prev is None:
+            todo.add(rel_path)
+            continue
+
+        desc = describe(source_path, rel_path, content_hash=False)
+        if desc['size'] == prev['size'] and desc['mtime'] == prev['mtime']:
+            continue
+
+        # size/mtime changed, only the content hash can tell if it really did
+        # (sources written without --incremental have no hash to compare)
+        desc['sha1'] = file_hash(os.path.join(source_path, rel_path))
+        if desc['sha1'] == prev.get('sha1'):
+            touched[rel_path] = desc
+        else:
+            print('Changed: {}'.format(rel_path))
+            stale.add(prev['shard'])
+            todo.add(rel_path)
+
+    stale.discard(None)
+    kept = dict((shard, desc) for shard, desc in manifest['shards'].items() if shard not in stale)
+
+    # survivors of rewritten shards get processed again along with new images
+    sources = {}
+    for rel_path, prev in manifest['sources'].items():
+        if rel_path not in current or rel_path in todo:
+            continue
+        if prev['shard'] in stale:
+            todo.add(rel_path)
+        else:
+            sources[rel_path] = dict(prev, **touched.get(rel_path, {}))
+
+    return kept, stale, sources, [row for row in images if row[0] in todo]
+
+def main(source_path, target_path, records, image_size, force, workers, seed, record_format, incremental,
+         stream=False, buffer=10000, shard_mb=None, compression='', shard_index=0, shard_count=1):
     info('Preprocess')
     raw_path = Path(source_path)
 
@@ -63,18 +293,47 @@ def main(source_path, target_path, records, image_size, force):
 
     index = dict((name, index) for index, name in enumerate(categories))
 
-    images = [[str(p.relative_to(source_path)),
-               str(p.parent.relative_to(source_path)),
-               index[str(p.parent.relative_to(source_path))]] for p in list(raw_path.glob('*/*'))]
+    if stream and incremental:
+        raise Exception('Incremental prep needs the full listing and cannot be streamed!')
+
+    # same seed => same shard contents
+    rng = random.Random(seed)
+    if stream:
+        print('Streaming images with a shuffle buffer of {}'.format(buffer))
+        images = shuffle_buffer(scan(source_path, categories, index), buffer, rng)
+    else:
+        images = sorted([[str(p.relative_to(source_path)),
+                          str(p.parent.relative_to(source_path)),
+                          index[str(p.parent.relative_to(source_path))]] for p in list(raw_path.glob('*/*'))])
+        rng.shuffle(images)
 
-    random.shuffle(images)
-    random.shuffle(images)
-    random.shuffle(images)
+    if not 0 <= shard_index < shard_count:
+        raise Exception('Slice {} is outside of 0..{}!'.format(shard_index, shard_count - 1))
+
+    prefix = ''
+    if shard_count > 1:
+        print('Processing slice {} of {}'.format(shard_index + 1, shard_count))
+        images = node_slice(images, shard_index, shard_count)
+        if not stream:
+            images = list(images)
+        prefix = 'node{:03d}-'.format(shard_index)
 
     # check for existing files on force clear
     write_path = os.path.join(target_path, 'tfrecords')
     processed_files = os.path.join(target_path, 'files.csv')
     out_file = os.path.join(target_path, 'metadata.json')
+    manifest_file = os.path.join(target_path, 'manifest.json')
+    settings = {
+        'image_size': image_size,
+        'format': record_format,
+        'compression': compression,
+        'records': records,
+        'shard_mb': shard_mb,
+        'format_version': RECORD_FORMAT_VERSION,
+        # label numbers are baked into the records, a new category list
+        # shifts them and invalidates every shard
+        'categories': categories
+    }
 
     if force and os.path.exists(write_path):
         info('Cleanup')
@@ -86,6 +345,34 @@ def main(source_path, target_path, records, image_size, force):
     if force and os.path.exists(out_file):
         print('Removing "{}"'.format(out_file))
         os.remove(out_file)
+    if force and os.path.exists(manifest_file):
+        print('Removing "{}"'.format(manifest_file))
+        os.remove(manifest_file)
+
+    manifest = None
+    if incremental:
+        info('Manifest')
+        manifest = load_manifest(manifest_file, settings)
+
+    shards, sources, start = {}, {}, 0
+    if manifest is not None:
+        shards, stale, sources, images = plan(source_path, images, manifest)
+        start = manifest['next_shard']
+        for shard in stale:
+            print('Removing stale shard "{}"'.format(shard))
+            if os.path.exists(os.path.join(target_path, shard)):
+                os.remove(os.path.join(target_path, shard))
+        print('Keeping {} shards, {} images to process'.format(len(shards), len(images)))
+
+    if shard_mb is not None:
+        info('Shard Size')
+        images = iter(images)
+        sample = list(itertools.islice(images, 16))
+        # nothing new to write (incremental) or nothing in this node's slice
+        if len(sample) > 0:
+            records = records_per_shard(source_path, sample, image_size, record_format, shard_mb, records)
+        images = itertools.chain(sample, images)
+
     info('Processing Images')
     
     if not os.path.exists(target_path):
@@ -94,52 +381,69 @@ def main(source_path, target_path, records, image_size, force):
     if not os.path.exists(write_path):
         os.makedirs(write_path)
 
-    print('Writing to {}'.format(write_path))
+    print('Writing to {} with {} worker(s)'.format(write_path, workers))
 
-    total_records = 0
-    tfrecords = []
-    writer = None
-    record_file = os.path.join(write_path, '{}.tfrecords')
+    new_shards = []
+    # only incremental runs compare content hashes, don't read every file twice otherwise
+    tasks = shard_tasks(source_path, write_path, images, records, image_size, record_format, compression, start, prefix,
+                        incremental)
+    for tfrecord, written in process(tasks, workers):
+        shard = str(Path(tfrecord).relative_to(target_path))
+        new_shards.append(shard)
+        count = 0
+        for rel_path, desc in written.items():
+            if desc['shard'] is not None:
+                desc['shard'] = shard
+                count += 1
+            sources[rel_path] = desc
+        shards[shard] = { 'records': count }
+        print('Wrote {} records to {}'.format(count, tfrecord))
 
-    for row in images:
-        if total_records % records == 0:
-            if writer != None:
-                writer.flush()
-                writer.close()
-            tfrecord = record_file.format('images{}_{}'.format(total_records//records, records))
-            tfrecords.append(tfrecord)
-            info('Writing to {}'.format(tfrecord))
-            writer = tf.io.TFRecordWriter(tfrecord)
-        try:
-            print('Trying {}...'.format(row[0]), end=' ')
-            image = example(source_path, row[0], row[2], image_size)
-            writer.write(image.SerializeToString())
-            total_records += 1
-            print('Success!')
-        except Exception as e:
-            print('Error: {}'.format(e))
+    kept = dict((shard, desc) for shard, desc in shards.items() if shard not in set(new_shards))
+    for shard, side in assign_splits(kept, new_shards).items():
+        shards[shard]['split'] = side
 
-    if writer != None:
-        writer.flush()
-        writer.close()
+    # training shards first, train.split cuts the listing at train_files
+    tfrecords = [shard for shard in shards if shards[shard]['split'] == 'train']
+    train_files = len(tfrecords)
+    tfrecords += [shard for shard in shards if shards[shard]['split'] == 'test']
+    print('{} training and {} test shards'.format(train_files, len(tfrecords) - train_files))
+    total_records = sum(shards[shard]['records'] for shard in tfrecords)
 
     info('Post process')
     
     print('Writing out record listing to {}'.format(processed_files))
-    with open(processed_files, 'w') as f:
+    with open(processed_files, 'w', newline='') as f:
+        writer = csv.writer(f)
         for line in tfrecords:
-            f.write('{}\n'.format(str(Path(line).relative_to(target_path))))
+            writer.writerow([line, shards[line]['records']])
+
+    print('Writing out manifest to {}'.format(manifest_file))
+    with open(manifest_file, 'w') as f:
+        json.dump({
+            'settings': settings,
+            'next_shard': start + len(new_shards),
+            'shards': shards,
+            'sources': sources
+        }, f)
 
     output = {
         'data': str(Path(write_path).relative_to(target_path)),
         'file': str(Path(processed_files).relative_to(target_path)),
         'image_size': image_size,
+        'format': record_format,
+        'format_version': RECORD_FORMAT_VERSION,
+        'compression': compression,
         'records': records,
         'categories': categories,
         'index': index,
+        'seed': seed,
+        'shard_index': shard_index,
+        'shard_count': shard_count,
         'generated': datetime.now().strftime('%m/%d/%y %H:%M:%S'),
         'total_records': total_records,
-        'total_files': len(tfrecords)
+        'total_files': len(tfrecords),
+        'train_files': train_files
     }
 
     print('Writing out metadata to {}'.format(out_file))
@@ -148,17 +452,114 @@ def main(source_path, target_path, records, image_size, force):
 
     print('Done!\nProcessed {} records.'.format(total_records))
 
+def copy_shard(task):
+    source, target = task
+    shutil.copyfile(source, target)
+    return target
+
+def merge(parts, target_path, workers=1):
+    info('Merge')
+    metadata = []
+    for part in parts:
+        with open(os.path.join(part, 'metadata.json')) as f:
+            metadata.append(json.load(f))
+        print('{} => slice {} of {}, {} records'.format(part, metadata[-1]['shard_index'] + 1,
+                                                     metadata[-1]['shard_count'], metadata[-1]['total_records']))
+
+    # every slice has to come from the same prep settings
+    first = metadata[0]
+    for key in ['categories', 'image_size', 'format', 'compression', 'shard_count']:
+        for part, m in zip(parts, metadata):
+            if m.get(key) != first.get(key):
+                raise Exception('"{}" differs between {} and {}!'.format(key, parts[0], part))
+
+    indices = sorted(m['shard_index'] for m in metadata)
+    if indices != list(range(first['shard_count'])):
+        raise Exception('Expected slices 0..{} but got {}!'.format(first['shard_count'] - 1, indices))
+
+    write_path = os.path.join(target_path, 'tfrecords')
+    processed_files = os.path.join(target_path, 'files.csv')
+    out_file = os.path.join(target_path, 'metadata.json')
+    if not os.path.exists(write_path):
+        os.makedirs(write_path)
+
+    # slices inside target_path are referenced in place, anything else
+    # (i.e. another pipeline output) is copied next to the listing. Every
+    # slice keeps its own train/test shards, training ones go first
+    train_rows, test_rows, copies = [], [], []
+    target = Path(target_path).resolve()
+    for part, m in sorted(zip(parts, metadata), key=lambda pm: pm[1]['shard_index']):
+        with open(os.path.join(part, m['file']), newline='') as f:
+            part_rows = [row for row in csv.reader(f) if len(row) > 0]
+        # slices from before train_files are cut by position like train.split
+        train_files = m.get('train_files', int(len(part_rows) * (SPLIT[0] / sum(SPLIT))))
+        for i, row in enumerate(part_rows):
+            rows = train_rows if i < train_files else test_rows
+            shard = Path(part).resolve() / row[0]
+            if target in shard.parents:
+                rows.append([str(shard.relative_to(target)), row[1]])
+            else:
+                copies.append((str(shard), os.path.join(write_path, shard.name)))
+                rows.append([str(Path(copies[-1][1]).relative_to(target_path)), row[1]])
+    rows = train_rows + test_rows
+
+    if len(copies) > 0:
+        print('Copying {} shards to {}'.format(len(copies), write_path))
+        with multiprocessing.pool.ThreadPool(max(1, min(workers, len(copies)))) as pool:
+            for target_file in pool.imap_unordered(copy_shard, copies):
+                print('Copied {}'.format(target_file))
+
+    print('Writing out record listing to {}'.format(processed_files))
+    with open(processed_files, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for row in rows:
+            writer.writerow(row)
+
+    output = dict(first)
+    output.update({
+        'data': str(Path(write_path).relative_to(target_path)),
+        'file': str(Path(processed_files).relative_to(target_path)),
+        'shard_index': 0,
+        'shard_count': 1,
+        'slices': len(parts),
+        'generated': datetime.now().strftime('%m/%d/%y %H:%M:%S'),
+        'total_records': sum(m['total_records'] for m in metadata),
+        'total_files': len(rows),
+        'train_files': len(train_rows)
+    })
+
+    print('Writing out metadata to {}'.format(out_file))
+    with open(str(out_file), 'w') as f:
+        json.dump(output, f)
+
+    print('Done!\nMerged {} records.'.format(output['total_records']))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='data cleaning for binary image task')
     parser.add_argument('-s', '--source_path', help='directory to raw data', default='data')
     parser.add_argument('-t', '--target_path', help='directory to cleaned data', default='data')
     parser.add_argument('-r', '--records', help='images per TFRecord', default=16, type=int)
+    parser.add_argument('-m', '--shard_mb', help='target TFRecord size in MB before compression (overrides --records)', default=None, type=float)
+    parser.add_argument('-c', '--compression', help='TFRecord compression', default='', choices=['', 'GZIP', 'ZLIB'])
     parser.add_argument('-i', '--image_size', help='resize height and width', default=160, type=int)
     parser.add_argument('-f', '--force', help='force clear all data', default=False, action='store_true')
+    parser.add_argument('--incremental', help='only process new or changed images (see manifest.json)', default=False, action='store_true')
+    parser.add_argument('--stream', help='write records while the source tree is still being listed', default=False, action='store_true')
+    parser.add_argument('--buffer', help='shuffle buffer size (images) when streaming', default=10000, type=int)
+    parser.add_argument('-w', '--workers', help='parallel prep processes', default=1, type=int)
+    parser.add_argument('--record_format', help='pixel encoding stored in each record', default='uint8', choices=RECORD_FORMATS)
+    parser.add_argument('--seed', help='shuffle seed (same seed, same shards)', default=None, type=int)
+    parser.add_argument('--shard_index', help='slice of the source tree processed by this node', default=0, type=int)
+    parser.add_argument('--shard_count', help='number of nodes the source tree is split across', default=1, type=int)
+    parser.add_argument('--merge', help='combine prep outputs of every slice into target_path', nargs='+', default=None)
     args = parser.parse_args()
 
     params = vars(args)
     for i in params:
         print('{} => {}'.format(i, params[i]))
 
-    main(**params)
\ No newline at end of file
+    parts = params.pop('merge')
+    if parts is not None:
+        merge(parts, params['target_path'], params['workers'])
+    else:
+        main(**params)
\ No newline at end of file
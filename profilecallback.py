@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+
+
+class ProfileCallback(tf.keras.callbacks.Callback):
+
+    def __init__(self, run, output_path, trace_steps=None):
+        super(ProfileCallback, self).__init__()
+        self.run = run
+        self.local = self.run.id.startswith('OfflineRun')
+        self.output_file = os.path.join(output_path, 'profile.json')
+        self.trace_path = os.path.join(output_path, 'trace')
+        # (first, last) global step of an optional TF profiler trace
+        self.trace_steps = trace_steps
+        self.tracing = False
+        self.step = 0
+        self.ready = None
+        self.epochs = []
+
+    def mark_ready(self):
+        self.ready = time.perf_counter()
+        return np.int64(0)
+
+    def wrap(self, ds):
+        # a synchronous map at the very end of the pipeline runs when the
+        # train step pulls the batch, so its timestamp splits waiting for
+        # input from running the step
+        def mark(*batch):
+            token = tf.py_function(self.mark_ready, [], tf.int64)
+            with tf.control_dependencies([token]):
+                return tuple(tf.identity(b) for b in batch)
+
+        options = tf.data.Options()
+        if hasattr(options.experimental_optimization, 'inject_prefetch'):
+            options.experimental_optimization.inject_prefetch = False
+        return ds.map(mark).with_options(options)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.times = { 'step': [], 'input': [], 'compute': [] }
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.trace_steps is not None and self.step == self.trace_steps[0]:
+            print('\nStarting profiler trace at step {} into {}'.format(self.step, self.trace_path))
+            tf.profiler.experimental.start(self.trace_path)
+            self.tracing = True
+        self.ready = None
+        self.begin = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        end = time.perf_counter()
+        ready = self.ready if self.ready is not None else self.begin
+        ready = min(max(ready, self.begin), end)
+        self.times['step'].append(end - self.begin)
+        self.times['input'].append(ready - self.begin)
+        self.times['compute'].append(end - ready)
+
+        if self.tracing and self.step >= self.trace_steps[1]:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+            print('\nStopped profiler trace at step {}'.format(self.step))
+        self.step += 1
+
+    def summarize(self, values):
+        values = np.array(values) * 1000.
+        if len(values) == 0:
+            return {}
+        counts, edges = np.histogram(values, bins=10)
+        return {
+            'mean_ms': float(values.mean()),
+            'p50_ms': float(np.percentile(values, 50)),
+            'p90_ms': float(np.percentile(values, 90)),
+            'p99_ms': float(np.percentile(values, 99)),
+            'max_ms': float(values.max()),
+            'histogram': { 'counts': counts.tolist(), 'edges_ms': edges.tolist() }
+        }
+
+    def on_epoch_end(self, epoch, logs=None):
+        summary = dict((k, self.summarize(v)) for k, v in self.times.items())
+        total = sum(self.times['step'])
+        summary['epoch'] = epoch
+        summary['steps'] = len(self.times['step'])
+        summary['input_fraction'] = sum(self.times['input']) / total if total > 0 else 0.
+        self.epochs.append(summary)
+
+        print('\nEpoch {}: step p50 {:.1f}ms p99 {:.1f}ms, {:.0%} waiting for input'.format(
+            epoch + 1, summary['step'].get('p50_ms', 0), summary['step'].get('p99_ms', 0), summary['input_fraction']))
+
+        if not self.local:
+            self.run.log('profile_input_fraction', summary['input_fraction'])
+            for k in ['step', 'input', 'compute']:
+                self.run.log(f'profile_{k}_p50_ms', summary[k].get('p50_ms', 0))
+                self.run.log(f'profile_{k}_p99_ms', summary[k].get('p99_ms', 0))
+        self.write()
+
+    def on_train_end(self, logs=None):
+        if self.tracing:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+        self.write()
+
+    def write(self):
+        with open(self.output_file, 'w') as f:
+            json.dump({ 'trace_steps': self.trace_steps, 'epochs': self.epochs }, f, indent=2)
@@ -2,11 +2,12 @@ import os
 import re
 import json
 import azureml
+import hashlib
 import argparse
 from pathlib import Path
-from shutil import copyfile
 from azureml.core.run import Run
 from azureml.core.model import Model
+from artifacts import ArtifactStore, LocalRegistry, AMLRegistry
 
 def info(msg, char = "#", width = 75):
     print("")
@@ -35,7 +36,77 @@ def best_model(source_path):
             
     return best_model
 
-def main(run, source_path, target_path, build):
+# post-training quantized copies exported next to model.hdf5 for CPU scoring
+QUANTIZATIONS = ['dynamic', 'float16', 'int8']
+
+def calibration_images(data_path, samples):
+    # representative inputs for full integer quantization, drawn from the
+    # training split of the prep output so the test split stays held out
+    import train
+    with open(os.path.join(data_path, 'metadata.json')) as f:
+        prep = json.load(f)
+    records, _ = train.split(train.load_records(data_path, prep), train_files=prep.get('train_files'))
+    img_shape = (prep['image_size'], prep['image_size'], 3)
+    ds = train.fast_dataset([filename for filename, _ in records], prep.get('format', 'float'),
+                            prep.get('compression', ''), img_shape, 1, training=False)
+    for images, _ in ds.take(samples):
+        yield [images]
+
+def export_tflite(model_file, target_path, data_path=None, samples=200):
+    import tensorflow as tf
+    model = tf.keras.models.load_model(str(model_file))
+    exported = {}
+    for quantization in QUANTIZATIONS:
+        if quantization == 'int8' and data_path is None:
+            print('No calibration data, skipping int8 export')
+            continue
+
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == 'float16':
+            converter.target_spec.supported_types = [tf.float16]
+        elif quantization == 'int8':
+            converter.representative_dataset = lambda: calibration_images(data_path, samples)
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+        tflite_file = os.path.join(target_path, 'model_{}.tflite'.format(quantization))
+        with open(tflite_file, 'wb') as f:
+            f.write(converter.convert())
+        print('Exported {} ({:.1f} MB)'.format(tflite_file, os.path.getsize(tflite_file) / (1024 * 1024)))
+        exported[quantization] = tflite_file
+    return exported
+
+def export_saved_model(model_file, target_path):
+    # the serving function traced once here, score.py loads the graph and
+    # weights without rebuilding the keras model from HDF5
+    import tensorflow as tf
+    model = tf.keras.models.load_model(str(model_file))
+    image_size = model.input_shape[1]
+    module = tf.Module()
+    module.model = model
+    module.serve = tf.function(lambda x: model(x, training=False),
+                               input_signature=[tf.TensorSpec([None, image_size, image_size, 3], tf.float32)])
+    saved_model_path = os.path.join(target_path, 'saved_model')
+    tf.saved_model.save(module, saved_model_path, signatures={ 'serving_default': module.serve })
+    print('Exported {}'.format(saved_model_path))
+    return saved_model_path
+
+def content_digest(model_digest, metadata):
+    # the weights plus whatever in metadata.json changes scoring, 'generated'
+    # and 'run' differ on every build and would defeat deduplication
+    stable = dict((k, v) for k, v in metadata.items() if k not in ['generated', 'run'])
+    content = '{}\n{}'.format(model_digest, json.dumps(stable, sort_keys=True))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def main(run, source_path, target_path, build, store_path, leaderboard=False, data_path=None, quantize=False, saved_model=False):
+    # a sweep output holds one training output per trial, take the winner
+    trial = None
+    if leaderboard:
+        with open(os.path.join(source_path, 'leaderboard.json')) as f:
+            trial = json.load(f)['trials'][0]
+        print('Best trial {} (val {}, {} epochs): {}'.format(trial['trial'], trial['val'], trial['epochs'], trial['params']))
+        source_path = os.path.join(source_path, trial['path'])
+
     # load previous step metadata
     train_step = os.path.join(source_path, 'metadata.json')
     with open(train_step) as f:
@@ -55,28 +126,57 @@ def main(run, source_path, target_path, build):
     for i in model:
         print('   {} => {}'.format(i, model[i]))
 
+    # files live once in the store, target_path gets links to them
+    info('Artifacts')
+    store = ArtifactStore(store_path)
+    model_digest = store.put(model['file'])
+    metadata_digest = store.put(os.path.join(source_path, metadata_file))
+
     target_model = os.path.join(target_path, model_file)
-    copyfile(str(model['file']), target_model)
+    print('{} => {} ({})'.format(model_digest, target_model, store.link(model_digest, target_model)))
     
     target_metadata = os.path.join(target_path, metadata_file)
-    copyfile(os.path.join(source_path, metadata_file), target_metadata)
+    print('{} => {} ({})'.format(metadata_digest, target_metadata, store.link(metadata_digest, target_metadata)))
 
     original_file = str(model['file'].relative_to(source_path))
     print('Original File: {}'.format(original_file))
 
-    # not offline - we can register in AML
-    if not run.id.lower().startswith('offlinerun'):
-        info('Register')
+    digest = content_digest(model_digest, train)
+    print('Content digest: {}'.format(digest))
+
+    # offline runs register against a local registry next to the store
+    info('Register')
+    if run.id.lower().startswith('offlinerun'):
+        registry = LocalRegistry(store_path)
+    else:
+        registry = AMLRegistry(run)
+
+    existing = registry.find('seer', digest)
+    if existing is not None:
+        # identical model already registered - just record the new build
+        print('Model already registered, skipping upload')
+        m = registry.tag(existing, { 'github_ref': build })
+    else:
+        if saved_model:
+            info('SavedModel')
+            export_saved_model(model['file'], target_path)
+        if quantize:
+            info('Quantize')
+            model['quantized'] = ','.join(export_tflite(model['file'], target_path, data_path).keys())
 
         # for tagging build number associated with build
         model['github_ref'] = build
         model['file'] = original_file
-        print(f'Uploading {target_path} to run {run.id} as the "model" folder')
+        model['sha256'] = digest
+        # store keys, target_path is overwritten by the next registration
+        model['model_digest'] = model_digest
+        model['metadata_digest'] = metadata_digest
+        if trial is not None:
+            model['trial'] = trial['trial']
+            model.update(trial['params'])
+        m = registry.register('seer', target_path, model)
+    print(m)
 
-        run.upload_folder('modelfiles', target_path)
-        m = run.register_model(model_name='seer', model_path='modelfiles', tags=model)
-        print(m)
-        
 
     print('Done!')
 
@@ -86,6 +186,11 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--source_path', help='directory to generated models', default='data/train')
     parser.add_argument('-t', '--target_path', help='write directory', default='data/model')
     parser.add_argument('-b', '--build', help='build identifier', default='1.0.0')
+    parser.add_argument('-l', '--leaderboard', help='source_path is a sweep output, register its best trial', default=False, action='store_true')
+    parser.add_argument('-q', '--quantize', help='also export quantized tflite models', default=False, action='store_true')
+    parser.add_argument('-e', '--saved_model', help='also export the serving graph as a SavedModel', default=False, action='store_true')
+    parser.add_argument('-d', '--data_path', help='prep output used to calibrate int8 quantization', default=None)
+    parser.add_argument('-a', '--store_path', help='content addressed artifact store', default='data/store')
     args = parser.parse_args()
 
     run = Run.get_context()
@@ -1,31 +1,339 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+
 import os
 import json
-import time
+import hashlib
+import queue
 import logging
-import requests
+import threading
+import collections
 import datetime
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 from io import BytesIO
 import tensorflow as tf
+from concurrent.futures import ThreadPoolExecutor
+
+# requests and azureml are imported where they are used, neither is needed
+# to score local images and both add to container start up
+IMPORT_TIME = time.perf_counter() - IMPORT_STARTED
+
+# largest batch sent through the model at once and concurrent image fetches
+MAX_BATCH = int(os.environ.get('SEER_MAX_BATCH', '32'))
+FETCH_WORKERS = int(os.environ.get('SEER_FETCH_WORKERS', '8'))
+
+# XLA compiles per input shape, so batches are padded to a few fixed sizes
+XLA = os.environ.get('SEER_XLA', '0') == '1'
+
+# concurrent single image requests share forward passes when enabled
+MICRO_BATCH = os.environ.get('SEER_MICRO_BATCH', '0') == '1'
+MICRO_BATCH_DELAY = float(os.environ.get('SEER_MICRO_BATCH_DELAY_MS', '5')) / 1000.
+
+# remote images: connect/read timeouts and total deadline in seconds, the
+# largest download accepted and the in-memory cache of downloaded bytes
+CONNECT_TIMEOUT = float(os.environ.get('SEER_CONNECT_TIMEOUT', '3'))
+FETCH_TIMEOUT = float(os.environ.get('SEER_FETCH_TIMEOUT', '10'))
+MAX_IMAGE_BYTES = int(os.environ.get('SEER_MAX_IMAGE_MB', '20')) * 1024 * 1024
+FETCH_CACHE_BYTES = int(os.environ.get('SEER_FETCH_CACHE_MB', '64')) * 1024 * 1024
+FETCH_CACHE_TTL = float(os.environ.get('SEER_FETCH_CACHE_TTL', '300'))
+
+# touched once init has warmed up, for container readiness probes
+READY_FILE = os.environ.get('SEER_READY_FILE')
+
+# optional cache of predictions keyed by image url and by input content
+PREDICTION_CACHE = os.environ.get('SEER_PREDICTION_CACHE', '0') == '1'
+PREDICTION_CACHE_ENTRIES = int(os.environ.get('SEER_PREDICTION_CACHE_ENTRIES', '10000'))
+PREDICTION_CACHE_BYTES = int(os.environ.get('SEER_PREDICTION_CACHE_MB', '32')) * 1024 * 1024
+PREDICTION_CACHE_TTL = float(os.environ.get('SEER_PREDICTION_CACHE_TTL', '3600'))
+
+# decode JPEGs at a reduced scale close to the model input instead of at
+# full resolution. prep.py builds training records with the same decode, 0
+# switches to the full resolution tensorflow resize, which no longer
+# matches training exactly and costs some accuracy
+FAST_DECODE = os.environ.get('SEER_FAST_DECODE', '1') == '1'
+
+# keras serves model.hdf5, saved_model the serving graph and dynamic/float16/
+# int8 the tflite exports register.py writes next to it, auto prefers the
+# saved_model because it loads without rebuilding the keras model
+ARTIFACT = os.environ.get('SEER_ARTIFACT', 'auto')
+TFLITE_THREADS = int(os.environ.get('SEER_TFLITE_THREADS', str(os.cpu_count() or 1)))
+
+# tensorflow thread pools, 0 leaves the tensorflow defaults (serve.py sizes
+# them so several workers don't oversubscribe the cores)
+INTRA_OP_THREADS = int(os.environ.get('SEER_INTRA_OP_THREADS', '0'))
+INTER_OP_THREADS = int(os.environ.get('SEER_INTER_OP_THREADS', '0'))
+
+class LRUCache(object):
+    """Thread safe least recently used cache bounded by the total size of
+    its values (and optionally their number), entries older than ttl
+    seconds count as misses. A hit credits the seconds it took to produce
+    the value to the 'saved' counter."""
+
+    def __init__(self, max_bytes, ttl=None, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+                self.remove(key)
+                self.counts['expired'] += 1
+                entry = None
+            if entry is None:
+                self.counts['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counts['hits'] += 1
+            self.counts['saved'] += entry[3]
+            return entry[0]
+
+    def put(self, key, value, size, cost=0.):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, size, time.monotonic(), cost)
+            self.size += size
+            while self.size > self.max_bytes or (self.max_entries is not None and len(self.entries) > self.max_entries):
+                self.remove(next(iter(self.entries)))
+                self.counts['evictions'] += 1
+
+    def remove(self, key):
+        size = self.entries.pop(key)[1]
+        self.size -= size
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.counts['hits'] + self.counts['misses']
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.counts['hits'],
+                'misses': self.counts['misses'],
+                'expired': self.counts['expired'],
+                'evictions': self.counts['evictions'],
+                'hit_rate': self.counts['hits'] / lookups if lookups > 0 else 0.,
+                'saved_ms': self.counts['saved'] * 1000.
+            }
+
+class Pending(object):
+    __slots__ = ['tensor', 'enqueued', 'done', 'result', 'error', 'batch_size', 'queue_delay']
+
+    def __init__(self, tensor):
+        self.tensor = tensor
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher(object):
+    """Queues single images from concurrent requests and runs them through
+    the model together, up to max_batch images or max_delay seconds after
+    the first one arrived."""
+
+    def __init__(self, predict_fn, max_batch=32, max_delay=0.005):
+        self.predict_fn = predict_fn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_sizes = collections.Counter()
+        self.queue_delays = collections.deque(maxlen=10000)
+        self.worker = threading.Thread(target=self.loop, name='MicroBatcher', daemon=True)
+        self.worker.start()
+
+    def submit(self, tensor):
+        pending = Pending(tensor)
+        self.queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending
 
-# azureml imports
-from azureml.core.model import Model
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].enqueued + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
 
-def init():
-    global model, image_size, index, categories
+    def loop(self):
+        while True:
+            batch = self.collect()
+            start = time.perf_counter()
+            try:
+                preds = self.predict_fn([p.tensor for p in batch])
+            except Exception as e:
+                preds = [None] * len(batch)
+                for p in batch:
+                    p.error = e
+
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+                for p in batch:
+                    self.queue_delays.append(start - p.enqueued)
+
+            for p, pred in zip(batch, preds):
+                p.result = pred
+                p.batch_size = len(batch)
+                p.queue_delay = start - p.enqueued
+                p.done.set()
+
+    def metrics(self):
+        with self.lock:
+            delays = np.array(self.queue_delays) * 1000.
+            sizes = dict(self.batch_sizes)
+        batches = sum(sizes.values())
+        return {
+            'batches': batches,
+            'mean_batch_size': sum(k * v for k, v in sizes.items()) / batches if batches > 0 else 0,
+            'batch_sizes': dict((str(k), sizes[k]) for k in sorted(sizes)),
+            'queue_delay_p50_ms': float(np.percentile(delays, 50)) if len(delays) > 0 else 0,
+            'queue_delay_p99_ms': float(np.percentile(delays, 99)) if len(delays) > 0 else 0
+        }
+
+class TFLiteModel(object):
+    """One interpreter shared by all requests. Interpreters are not thread
+    safe, so invocations are serialized behind a lock; the input stays at
+    batch 1 so tensors are allocated once instead of on every resize."""
+
+    def __init__(self, model_path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.lock = threading.Lock()
+
+    def quantize(self, x, details):
+        scale, zero_point = details['quantization']
+        if details['dtype'] == np.float32 or scale == 0:
+            return x.astype(details['dtype'])
+        return np.round(x / scale + zero_point).astype(details['dtype'])
+
+    def dequantize(self, x, details):
+        scale, zero_point = details['quantization']
+        if details['dtype'] == np.float32 or scale == 0:
+            return x.astype(np.float32)
+        return (x.astype(np.float32) - zero_point) * scale
+
+    def __call__(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        preds = []
+        with self.lock:
+            for image in images:
+                self.interpreter.set_tensor(self.input['index'], self.quantize(image[np.newaxis], self.input))
+                self.interpreter.invoke()
+                preds.append(self.dequantize(self.interpreter.get_tensor(self.output['index']), self.output)[0])
+        return np.stack(preds)
+
+def compile_model(model, image_size, xla=False):
+    # traced once for the fixed input signature instead of going through
+    # Keras predict's data adapter and loop on every call
+    fn = lambda x: model(x, training=False)
+    signature = [tf.TensorSpec([None, image_size, image_size, 3], tf.float32)]
+    try:
+        return tf.function(fn, input_signature=signature, jit_compile=xla)
+    except TypeError:
+        return tf.function(fn, input_signature=signature, experimental_compile=xla)
+
+def buckets(max_batch):
+    sizes = [1]
+    while sizes[-1] < max_batch:
+        sizes.append(min(sizes[-1] * 2, max_batch))
+    return sizes
+
+def warm_up(infer, image_size, sizes):
+    start = time.perf_counter()
+    for size in sizes:
+        infer(tf.zeros([size, image_size, image_size, 3]))
+    print('Warmed up batch sizes {} in {:.2f}s'.format(sizes, time.perf_counter() - start))
+
+def load_artifact(path, artifact, image_size, xla=False):
+    saved_model_path = os.path.join(path, 'saved_model')
+    tflite_path = os.path.join(path, 'model_{}.tflite'.format(artifact))
+    if artifact == 'auto':
+        artifact = 'saved_model' if os.path.exists(saved_model_path) else 'keras'
+    elif artifact == 'saved_model' and not os.path.exists(saved_model_path):
+        print('{} not found, serving the keras model'.format(saved_model_path))
+        artifact = 'keras'
+    elif artifact not in ['keras', 'saved_model'] and not os.path.exists(tflite_path):
+        print('{} not found, serving the keras model'.format(tflite_path))
+        artifact = 'keras'
+
+    if artifact == 'keras':
+        model_path = os.path.join(path, 'model.hdf5')
+        print('Attempting to load model')
+        model = tf.keras.models.load_model(model_path)
+        return artifact, model_path, model, compile_model(model, image_size, xla)
+
+    if artifact == 'saved_model':
+        # the traced serving function, no keras layers are rebuilt
+        print('Loading {}'.format(saved_model_path))
+        model = tf.saved_model.load(saved_model_path)
+        infer = compile_model(lambda x, training=False: model.serve(x), image_size, True) if xla else model.serve
+        return artifact, saved_model_path, model, infer
+
+    print('Loading {} interpreter ({} threads)'.format(tflite_path, TFLITE_THREADS))
+    model = TFLiteModel(tflite_path, TFLITE_THREADS)
+    return artifact, tflite_path, model, model
+
+def file_digest(path):
+    # a directory (saved_model) hashes its files in name order
+    files = [path]
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    sha256 = hashlib.sha256()
+    for name in files:
+        with open(name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(chunk)
+    return sha256.hexdigest()
+
+def http_session(pool_size):
+    # keep-alive connections shared by the fetch threads, one pool per host
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+ready = threading.Event()
+startup = { 'import_s': IMPORT_TIME }
+http = None
+http_lock = threading.Lock()
+version_lock = threading.Lock()
+
+def init(path=None):
+    global model, infer, artifact, model_path, pad_batches, model_version, image_size, index, categories, fetch_pool, download_cache, prediction_cache, batcher
+    ready.clear()
+    init_started = time.perf_counter()
 
     #aml_logger = logging.getLogger('azureml')
     #aml_logger.setLevel(logging.DEBUG)
     #server_logger = logging.getLogger('root')
     #server_logger.setLevel(logging.DEBUG)
 
-    try:
-        path = Model.get_model_path('seer')
-    except:
-        path = 'data/model'
+    if path is None:
+        try:
+            from azureml.core.model import Model
+            path = Model.get_model_path('seer')
+        except:
+            path = 'data/model'
 
-    model_path = os.path.join(path, 'model.hdf5')
     meta_path = os.path.join(path, 'metadata.json')
     print('Loading {}'.format(meta_path))
 
@@ -39,54 +347,300 @@ def init():
     index = metadata['index']
     categories = metadata['categories']
 
-    print('Attempting to load model')
-    model = tf.keras.models.load_model(model_path)
-    model.summary()
+    # only takes effect before tensorflow runs its first op
+    try:
+        if INTRA_OP_THREADS > 0:
+            tf.config.threading.set_intra_op_parallelism_threads(INTRA_OP_THREADS)
+        if INTER_OP_THREADS > 0:
+            tf.config.threading.set_inter_op_parallelism_threads(INTER_OP_THREADS)
+    except RuntimeError as e:
+        print('Could not set thread pools ({})'.format(e))
+
+    start = time.perf_counter()
+    artifact, model_path, model, infer = load_artifact(path, ARTIFACT, image_size, XLA)
+    startup['load_s'] = time.perf_counter() - start
+    print('Loaded {} in {:.2f}s'.format(model_path, startup['load_s']))
+
+    # only hashed when the prediction cache needs it (see below)
+    model_version = None
+
+    start = time.perf_counter()
+    pad_batches = XLA and not isinstance(model, TFLiteModel)
+    warm_up(infer, image_size, buckets(MAX_BATCH) if pad_batches else [1, MAX_BATCH])
+    startup['warmup_s'] = time.perf_counter() - start
+
+    fetch_pool = ThreadPoolExecutor(FETCH_WORKERS)
+    download_cache = LRUCache(FETCH_CACHE_BYTES, FETCH_CACHE_TTL)
+    prediction_cache = LRUCache(PREDICTION_CACHE_BYTES, PREDICTION_CACHE_TTL, PREDICTION_CACHE_ENTRIES) if PREDICTION_CACHE else None
+    batcher = MicroBatcher(predict, MAX_BATCH, MICRO_BATCH_DELAY) if MICRO_BATCH else None
+    if prediction_cache is not None:
+        # before ready, not inside the first request that looks up the cache
+        start = time.perf_counter()
+        version()
+        startup['version_s'] = time.perf_counter() - start
+    startup['init_s'] = time.perf_counter() - init_started
+    startup['artifact'] = artifact
+
+    ready.set()
+    if READY_FILE is not None:
+        with open(READY_FILE, 'w') as f:
+            json.dump(startup, f)
     print('Done!')
-    print('Initialized model "{}" at {}'.format(model_path, datetime.datetime.now()))
+    print('Initialized model "{}" at {} ({})'.format(model_path, datetime.datetime.now(),
+        ', '.join('{} {:.2f}s'.format(k[:-2], v) for k, v in startup.items() if k.endswith('_s'))))
 
-def process_image(path):
-    global image_size
+def is_ready():
+    return ready.is_set()
+
+def version():
+    # cached predictions belong to exactly these weights
+    global model_version
+    if model_version is None:
+        with version_lock:
+            if model_version is None:
+                model_version = '{}:{}'.format(artifact, file_digest(model_path)[:16])
+                print('Model version {}'.format(model_version))
+    return model_version
 
+def fetch(url):
+    global http, download_cache
+    content = download_cache.get(url)
+    if content is not None:
+        return content
+
+    if http is None:
+        with http_lock:
+            if http is None:
+                http = http_session(FETCH_WORKERS)
+
+    # stream so oversized or slow downloads are cut off early
+    deadline = time.monotonic() + FETCH_TIMEOUT
+    with http.get(url, timeout=(CONNECT_TIMEOUT, FETCH_TIMEOUT), stream=True) as response:
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length is not None and int(length) > MAX_IMAGE_BYTES:
+            raise ValueError('{} is {} bytes, limit is {}'.format(url, length, MAX_IMAGE_BYTES))
+        chunks, size = [], 0
+        for chunk in response.iter_content(64 * 1024):
+            size += len(chunk)
+            if size > MAX_IMAGE_BYTES:
+                raise ValueError('{} is larger than {} bytes'.format(url, MAX_IMAGE_BYTES))
+            if time.monotonic() > deadline:
+                raise TimeoutError('{} took longer than {}s'.format(url, FETCH_TIMEOUT))
+            chunks.append(chunk)
+
+    content = b''.join(chunks)
+    download_cache.put(url, content, len(content))
+    return content
+
+def open_image(path):
     # Extract image (from web or path)
     if(path.startswith('http')):
-        response = requests.get(path)
-        img = np.array(Image.open(BytesIO(response.content)))
-    else:
-        img = np.array(Image.open(path))
+        return Image.open(BytesIO(fetch(path)))
+    return Image.open(path)
+
+def decode_full(img, size):
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img_tensor = tf.convert_to_tensor(np.asarray(img), dtype=tf.float32)
+    return tf.image.resize(img_tensor, [size, size]) / 255
 
-    img_tensor = tf.convert_to_tensor(img, dtype=tf.float32)
-    img_final = tf.image.resize(img_tensor, [image_size, image_size]) / 255
-    return img_final
+def resize_image(img, size):
+    # shared with prep.py so training records and requests see the same
+    # pixels: upright, RGB and squashed to size x size in uint8
+    # the JPEG decoder scales by 1/2, 1/4 or 1/8 while decoding, draft picks
+    # the smallest scale that still covers size x size
+    if img.format == 'JPEG':
+        img.draft('RGB', (size, size))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return np.asarray(img.resize((size, size), Image.BILINEAR))
+
+def decode_reduced(img, size):
+    return tf.convert_to_tensor(resize_image(img, size), dtype=tf.float32) / 255
+
+def process_image(path):
+    global image_size
+    img = open_image(path)
+    decode = decode_reduced if FAST_DECODE else decode_full
+    return decode(img, image_size)
+
+def try_process_image(path):
+    try:
+        return process_image(path)
+    except Exception as e:
+        return e
+
+def process_images(paths):
+    # fetch and decode concurrently, failures come back as exceptions
+    global fetch_pool
+    return list(fetch_pool.map(try_process_image, paths))
+
+def predict(tensors):
+    global infer, pad_batches, image_size
+    preds = []
+    for i in range(0, len(tensors), MAX_BATCH):
+        t = tf.reshape(tf.stack(tensors[i:i+MAX_BATCH]), [-1, image_size, image_size, 3])
+        n = t.shape[0]
+        if pad_batches:
+            # pad up to the next warmed up size so nothing recompiles
+            size = next(b for b in buckets(MAX_BATCH) if b >= n)
+            t = tf.pad(t, [[0, size - n], [0, 0], [0, 0], [0, 0]])
+        pred = infer(t)
+        preds.extend((pred.numpy() if hasattr(pred, 'numpy') else pred)[:n])
+    return preds
+
+def scores(pred):
+    global categories
+    predictions = {}
+    for i in range(len(pred)):
+        predictions[categories[i]] = str(pred[i])
+    return categories[int(np.argmax(pred))], predictions
+
+def url_key(path):
+    # remote images are assumed immutable under their url, local files are not,
+    # anything that isn't a string fails in try_process_image for that image only
+    global prediction_cache
+    if prediction_cache is None or not isinstance(path, str) or not path.startswith('http'):
+        return None
+    return (version(), path)
+
+def content_key(tensor):
+    global prediction_cache
+    if prediction_cache is None:
+        return None
+    return (version(), hashlib.sha256(np.asarray(tensor).tobytes()).hexdigest())
+
+def lookup(key):
+    global prediction_cache
+    return prediction_cache.get(key) if key is not None else None
+
+def store(key, pred, cost):
+    global prediction_cache
+    if key is not None:
+        prediction_cache.put(key, pred, pred.nbytes + 256, cost)
+
+def run_batch(paths, prev_time):
+    start = time.perf_counter()
+    preds, hits = {}, {}
+    for i, path in enumerate(paths):
+        pred = lookup(url_key(path))
+        if pred is not None:
+            preds[i], hits[i] = pred, 'url'
+
+    todo = [i for i in range(len(paths)) if i not in preds]
+    tensors = dict(zip(todo, process_images([paths[i] for i in todo])))
+    ok = [i for i in todo if not isinstance(tensors[i], Exception)]
+    keys = dict((i, content_key(tensors[i])) for i in ok)
+    for i in ok:
+        pred = lookup(keys[i])
+        if pred is not None:
+            preds[i], hits[i] = pred, 'content'
+
+    # the cost credited to each entry is its share of the batch
+    infer_start = time.perf_counter()
+    timing = { 'preprocess_ms': (infer_start - start) * 1000. }
+    missing = [i for i in ok if i not in preds]
+    if len(missing) > 0:
+        preds.update(zip(missing, predict([tensors[i] for i in missing])))
+        timing['inference_ms'] = (time.perf_counter() - infer_start) * 1000.
+        infer_cost = (time.perf_counter() - infer_start) / len(missing)
+        fetch_cost = (infer_start - start) / max(len(todo), 1)
+        for i in missing:
+            store(keys[i], preds[i], infer_cost)
+            store(url_key(paths[i]), preds[i], fetch_cost + infer_cost)
+
+    results = []
+    for i, path in enumerate(paths):
+        if i in preds:
+            prediction, predictions = scores(preds[i])
+            results.append({ 'image': path, 'prediction': prediction, 'scores': predictions })
+            if i in hits:
+                results[-1]['cached'] = hits[i]
+        else:
+            results.append({ 'image': path, 'error': str(tensors[i]) })
+
+    timing['total_ms'] = (time.perf_counter() - start) * 1000.
+    inference_time = datetime.timedelta(seconds=time.time() - prev_time)
+    payload = {
+        'time': str(inference_time.total_seconds()),
+        'timing': timing,
+        'results': results
+    }
+
+    print('Input ({} images), {} cached, {} failed'.format(len(paths), len(hits), len(paths) - len(preds)))
+
+    return payload
+
+def metrics():
+    global batcher, download_cache, prediction_cache
+    return {
+        'ready': is_ready(),
+        'startup': startup,
+        'micro_batch': batcher.metrics() if batcher is not None else None,
+        'download_cache': download_cache.metrics(),
+        'prediction_cache': prediction_cache.metrics() if prediction_cache is not None else None
+    }
 
 def run(raw_data):
-    global model, image_size, index, categories
+    global model, image_size, index, categories, batcher
     prev_time = time.time()
           
     post = json.loads(raw_data)
 
+    # {"images": [...]} (or a list under "image") scores a batch
+    images = post.get('images', post.get('image'))
+    if isinstance(images, list):
+        return run_batch(images, prev_time)
+
     # get image
     img_path = post['image']
-    tensor = process_image(img_path)
-    t = tf.reshape(tensor, [-1, image_size, image_size, 3])
-
-    # predict with model (there's only one)
-    pred = model.predict(t, steps=1)[0]
+    start = time.perf_counter()
+    batching, cached, timing = None, None, {}
+    key = url_key(img_path)
+    pred = lookup(key)
+    if pred is not None:
+        cached = 'url'
+    else:
+        tensor = process_image(img_path)
+        timing['preprocess_ms'] = (time.perf_counter() - start) * 1000.
+        tensor_key = content_key(tensor)
+        pred = lookup(tensor_key)
+        if pred is not None:
+            cached = 'content'
+        else:
+            # predict with model (there's only one)
+            infer_start = time.perf_counter()
+            if batcher is not None:
+                pending = batcher.submit(tensor)
+                pred = pending.result
+                batching = { 'size': pending.batch_size, 'queue_ms': pending.queue_delay * 1000. }
+            else:
+                pred = predict([tensor])[0]
+            timing['inference_ms'] = (time.perf_counter() - infer_start) * 1000.
+            store(tensor_key, pred, time.perf_counter() - infer_start)
+        store(key, pred, time.perf_counter() - start)
+    timing['total_ms'] = (time.perf_counter() - start) * 1000.
     print(pred)
 
     current_time = time.time()
     inference_time = datetime.timedelta(seconds=current_time - prev_time)
 
-    predictions = {}
-    for i in range(len(pred)):
-        predictions[categories[i]] = str(pred[i])
+    prediction, predictions = scores(pred)
 
     payload = {
         'time': str(inference_time.total_seconds()),
-        'prediction': categories[int(np.argmax(pred))],
+        'prediction': prediction,
         'scores': predictions,
+        'timing': timing,
         'ANOTHER': 'YAY!'
     }
+    if batching is not None:
+        payload['batch'] = batching
+    if cached is not None:
+        payload['cached'] = cached
 
     print('Input ({}),\nPrediction ({})'.format(post['image'], payload))
 
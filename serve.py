@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import mmap
+import time
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import traceback
+import http.server
+import socketserver
+
+# nothing tensorflow is imported here: the parent only maps the model file
+# and forks, every worker starts its own runtime after the fork
+TFLITE = ['dynamic', 'float16', 'int8']
+
+def info(msg, char = "#", width = 75):
+    print("")
+    print(char * width)
+    print(char + "   %0*s" % ((-1*width)+5, msg) + char)
+    print(char * width)
+
+def share(model_path, artifact):
+    # the tflite interpreter mmaps its model file read only, so once the
+    # pages are in the page cache every worker maps the same physical copy
+    tflite_path = os.path.join(model_path, 'model_{}.tflite'.format(artifact))
+    if artifact not in TFLITE or not os.path.exists(tflite_path):
+        print('Every worker loads its own copy of the {} model, only tflite artifacts are shared'.format(artifact))
+        return None
+    f = open(tflite_path, 'rb')
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    for offset in range(0, len(mapped), mmap.PAGESIZE):
+        mapped[offset]
+    print('Mapped {} ({:.1f} MB) for the workers'.format(tflite_path, len(mapped) / (1024 * 1024)))
+    return f, mapped
+
+def thread_env(workers, threads=None):
+    # split the cores between workers instead of every runtime sizing its
+    # pools to the whole machine
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    return {
+        'SEER_TFLITE_THREADS': str(threads),
+        'SEER_INTRA_OP_THREADS': str(threads),
+        'SEER_INTER_OP_THREADS': '1',
+        'OMP_NUM_THREADS': str(threads)
+    }
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # keep-alive so load generators reuse their connections
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        import score
+        if self.path == '/ready':
+            self.reply(200 if score.is_ready() else 503, { 'ready': score.is_ready(), 'pid': os.getpid() })
+        elif self.path == '/metrics':
+            metrics = score.metrics()
+            metrics['pid'] = os.getpid()
+            self.reply(200, metrics)
+        else:
+            self.reply(404, { 'error': 'unknown path {}'.format(self.path) })
+
+    def do_POST(self):
+        import score
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        if self.path not in ['/', '/score']:
+            self.reply(404, { 'error': 'unknown path {}'.format(self.path) })
+            return
+        try:
+            self.reply(200, score.run(body))
+        except Exception as e:
+            self.reply(500, { 'error': str(e) })
+
+    def log_message(self, *args):
+        pass
+
+class WorkerServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def worker(listener, model_path, env, ready_file):
+    os.environ.update(env)
+    if ready_file is not None:
+        os.environ['SEER_READY_FILE'] = ready_file
+    import score
+    score.init(model_path)
+
+    # accept on the socket the parent bound, the kernel hands each
+    # connection to one of the workers waiting on it
+    server = WorkerServer(listener.getsockname(), Handler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = listener
+    server.serve_forever()
+
+def main(model_path, host, port, workers, artifact, threads, ready_path):
+    info('Serve')
+    env = thread_env(workers, threads)
+    env['SEER_ARTIFACT'] = artifact
+    for k, v in env.items():
+        print('{} => {}'.format(k, v))
+    # kept open for the life of the parent so the pages stay cached
+    shared = share(model_path, artifact)
+
+    # readiness files tell a worker that never finished score.init apart
+    # from one that died while serving
+    temporary = ready_path is None
+    ready_path = tempfile.mkdtemp(prefix='seer-serve-') if temporary else ready_path
+    os.makedirs(ready_path, exist_ok=True)
+    for name in os.listdir(ready_path):
+        os.remove(os.path.join(ready_path, name))
+    ready_files = [os.path.join(ready_path, 'worker{}.json'.format(i)) for i in range(workers)]
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+    print('Listening on http://{}:{} with {} workers'.format(host, port, workers))
+
+    running = {}
+    def spawn(i):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                worker(listener, model_path, env, ready_files[i])
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        print('Started worker {} (pid {})'.format(i, pid))
+        running[pid] = i
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(running):
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(workers):
+        spawn(i)
+
+    # worker slot => time its restart is due, delays double while a slot
+    # keeps dying soon after getting ready
+    restarts, failures = {}, [0] * workers
+    while len(running) > 0 or (len(restarts) > 0 and not stopping):
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid, status = 0, 0
+        if pid == 0:
+            now = time.time()
+            for i, due in list(restarts.items()):
+                if not stopping and now >= due:
+                    del restarts[i]
+                    spawn(i)
+            time.sleep(0.2)
+            continue
+        if pid not in running:
+            continue
+        i = running.pop(pid)
+        if stopping:
+            continue
+
+        if not os.path.exists(ready_files[i]):
+            # score.init itself fails, restarting would only fail again
+            print('Worker {} (pid {}) exited with {} before it was ready, shutting down'.format(i, pid, status))
+            stop(None, None)
+            continue
+
+        if time.time() - os.path.getmtime(ready_files[i]) > 60:
+            failures[i] = 0
+        os.remove(ready_files[i])
+        delay = min(2 ** failures[i], 60)
+        failures[i] += 1
+        print('Worker {} (pid {}) exited with {}, restarting in {}s'.format(i, pid, status, delay))
+        restarts[i] = time.time() + delay
+
+    listener.close()
+    if temporary:
+        shutil.rmtree(ready_path, ignore_errors=True)
+    print('Done!')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='pre-fork http server running score.py in several worker processes (Linux)')
+    parser.add_argument('-m', '--model_path', help='registered model folder', default=os.environ.get('AZUREML_MODEL_DIR', 'data/model'))
+    parser.add_argument('--host', help='address to listen on', default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='port to listen on', default=8000, type=int)
+    parser.add_argument('-w', '--workers', help='worker processes', default=os.cpu_count() or 1, type=int)
+    parser.add_argument('-a', '--artifact', help='model artifact (see score.py SEER_ARTIFACT), tflite ones are shared between workers', default='dynamic')
+    parser.add_argument('-t', '--threads', help='threads per worker (cores / workers if omitted)', default=None, type=int)
+    parser.add_argument('-r', '--ready_path', help='directory each worker writes a file to once it is warmed up', default=None)
+    args = parser.parse_args()
+
+    sys.exit(main(**vars(args)))
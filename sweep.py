@@ -0,0 +1,235 @@
+import os
+import json
+import math
+import random
+import argparse
+import multiprocessing
+import multiprocessing.connection
+from datetime import datetime
+
+# several trials share one GPU, don't let the first one grab all of it
+os.environ.setdefault('TF_FORCE_GPU_ALLOW_GROWTH', 'true')
+
+DEFAULT_SPACE = {
+    'lr': { 'log': [0.0001, 0.01] },
+    'batch': { 'choice': [10, 16, 32] }
+}
+
+def info(msg, char = "#", width = 75):
+    print("")
+    print(char * width)
+    print(char + "   %0*s" % ((-1*width)+5, msg) + char)
+    print(char * width)
+
+def sample(space, rng):
+    params = {}
+    for name, dist in space.items():
+        if 'choice' in dist:
+            params[name] = rng.choice(dist['choice'])
+        elif 'log' in dist:
+            low, high = dist['log']
+            params[name] = math.exp(rng.uniform(math.log(low), math.log(high)))
+        elif 'uniform' in dist:
+            params[name] = rng.uniform(*dist['uniform'])
+        else:
+            raise ValueError('Unknown distribution for "{}": {}'.format(name, dist))
+    return params
+
+class ASHA(object):
+    """Asynchronous successive halving: a trial moves up a rung once it is
+    in the top 1/eta of everything that finished the rung below."""
+
+    def __init__(self, min_epochs, max_epochs, eta):
+        self.eta = eta
+        self.rungs = []
+        epochs = min_epochs
+        while epochs < max_epochs:
+            self.rungs.append(epochs)
+            epochs *= eta
+        self.rungs.append(max_epochs)
+        self.results = [{} for _ in self.rungs]
+        self.promoted = [set() for _ in self.rungs]
+
+    def report(self, trial, rung, score):
+        self.results[rung][trial] = score
+
+    def promotion(self):
+        # highest rung first so good trials finish as early as possible
+        for rung in reversed(range(len(self.rungs) - 1)):
+            done = self.results[rung]
+            top = sorted(done, key=done.get, reverse=True)[:len(done) // self.eta]
+            for trial in top:
+                if trial not in self.promoted[rung]:
+                    self.promoted[rung].add(trial)
+                    return trial, rung + 1
+        return None
+
+def run_trial(source_path, trial_path, trial, epochs, params, pipeline, cache):
+    # each rung continues from the trial's checkpoints (see train.finetune)
+    import train
+    import tensorflow as tf
+    from azureml.core.run import Run
+
+    parent = Run.get_context()
+    offline = parent.id.startswith('OfflineRun')
+    run = parent if offline else parent.child_run(name=trial)
+    try:
+        # own disk cache per trial, concurrent trials can't fill the same one
+        train.main(run, source_path, trial_path, epochs, params['batch'], params['lr'],
+                   pipeline=pipeline, cache=cache, cache_path=os.path.join(trial_path, 'cache'))
+    finally:
+        if not offline:
+            run.complete()
+
+    # score the state this rung ended in, the hdf5 files of earlier rungs
+    # sit in the same folder and would flatter trials that got worse
+    latest = tf.train.latest_checkpoint(os.path.join(trial_path, 'checkpoints'))
+    return float(tf.train.load_variable(latest, 'val_accuracy/.ATTRIBUTES/VARIABLE_VALUE')) if latest else 0.
+
+def trial_process(conn, *args):
+    # (score, error) goes back over the pipe, a process that dies without
+    # sending anything (OOM killer, crash in TF) shows up as EOF instead
+    try:
+        conn.send((run_trial(*args), None))
+    except Exception as e:
+        conn.send((0., '{}: {}'.format(type(e).__name__, e)))
+    finally:
+        conn.close()
+
+def main(source_path, target_path, trials, workers, min_epochs, max_epochs, eta, space, seed,
+         pipeline, cache, stage_path):
+    info('Sweep')
+    if not os.path.exists(target_path):
+        os.makedirs(target_path)
+
+    if space is not None:
+        with open(space) as f:
+            space = json.load(f)
+    else:
+        space = DEFAULT_SPACE
+
+    # one local copy of the prep output shared by every trial
+    if stage_path is not None:
+        import train
+        train.stage(source_path, stage_path)
+        source_path = stage_path
+
+    rng = random.Random(seed)
+    scheduler = ASHA(min_epochs, max_epochs, eta)
+    print('Rungs (epochs): {}'.format(scheduler.rungs))
+
+    configs, started = {}, 0
+    def next_job():
+        nonlocal started
+        promotion = scheduler.promotion()
+        if promotion is not None:
+            return promotion
+        if started < trials:
+            trial = 'trial{:03d}'.format(started)
+            configs[trial] = sample(space, rng)
+            started += 1
+            return trial, 0
+        return None
+
+    leaderboard_file = os.path.join(target_path, 'leaderboard.json')
+    # one trial per child process so graphs and GPU memory of finished
+    # trials are released with the process
+    context = multiprocessing.get_context('spawn')
+    running = {}
+    def submit(job):
+        trial, rung = job
+        epochs = scheduler.rungs[rung]
+        print('Starting {} for {} epochs: {}'.format(trial, epochs, configs[trial]))
+        receive, send = context.Pipe(duplex=False)
+        process = context.Process(target=trial_process,
+                                  args=(send, source_path, os.path.join(target_path, trial), trial,
+                                        epochs, configs[trial], pipeline, cache))
+        process.start()
+        send.close()
+        running[process.sentinel] = (job, process, receive)
+
+    try:
+        for _ in range(workers):
+            job = next_job()
+            if job is not None:
+                submit(job)
+
+        while len(running) > 0:
+            # wakes up when a trial process exits, however it exits
+            for sentinel in multiprocessing.connection.wait(list(running.keys())):
+                (trial, rung), process, receive = running.pop(sentinel)
+                process.join()
+                try:
+                    score, error = receive.recv()
+                except EOFError:
+                    score, error = 0., 'process exited with code {}'.format(process.exitcode)
+                receive.close()
+
+                if error is not None:
+                    print('{} failed: {}'.format(trial, error))
+                print('{} finished rung {} with val {:.4f}'.format(trial, scheduler.rungs[rung], score))
+                scheduler.report(trial, rung, score)
+                write_leaderboard(leaderboard_file, scheduler, configs)
+
+                job = next_job()
+                if job is not None:
+                    submit(job)
+    except BaseException:
+        for _, process, _ in running.values():
+            process.terminate()
+        raise
+    finally:
+        for _, process, receive in running.values():
+            process.join()
+            receive.close()
+
+    leaderboard = write_leaderboard(leaderboard_file, scheduler, configs)
+    info('Leaderboard')
+    for entry in leaderboard['trials'][:10]:
+        print('{trial} val {val:.4f} after {epochs} epochs {params}'.format(**entry))
+    print('Done!')
+
+def write_leaderboard(leaderboard_file, scheduler, configs):
+    # rank by furthest rung reached, then by the score at that rung
+    entries = {}
+    for rung, results in enumerate(scheduler.results):
+        for trial, score in results.items():
+            entries[trial] = {
+                'trial': trial,
+                'path': trial,
+                'params': configs[trial],
+                'rung': rung,
+                'epochs': scheduler.rungs[rung],
+                'val': score
+            }
+    ranked = sorted(entries.values(), key=lambda e: (e['rung'], e['val']), reverse=True)
+    leaderboard = {
+        'generated': datetime.now().strftime('%m/%d/%y %H:%M:%S'),
+        'rungs': scheduler.rungs,
+        'trials': ranked
+    }
+    with open(leaderboard_file, 'w') as f:
+        json.dump(leaderboard, f, indent=2)
+    return leaderboard
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='hyperparameter sweep with successive halving')
+    parser.add_argument('-s', '--source_path', help='directory to prepped data', default='data/prep')
+    parser.add_argument('-t', '--target_path', help='directory for trials and leaderboard.json', default='data/sweep')
+    parser.add_argument('-n', '--trials', help='number of sampled configurations', default=27, type=int)
+    parser.add_argument('-w', '--workers', help='trials trained at the same time', default=4, type=int)
+    parser.add_argument('--min_epochs', help='epochs before the first cut', default=1, type=int)
+    parser.add_argument('--max_epochs', help='epochs for trials that make it to the end', default=15, type=int)
+    parser.add_argument('--eta', help='keep the top 1/eta at every rung', default=3, type=int)
+    parser.add_argument('--space', help='json search space (default: lr log [1e-4, 1e-2], batch [10, 16, 32])', default=None)
+    parser.add_argument('--seed', help='sampling seed', default=None, type=int)
+    parser.add_argument('-p', '--pipeline', help='input pipeline', default='fast')
+    parser.add_argument('--cache', help='cache decoded records across epochs', default='none', choices=['none', 'memory', 'disk'])
+    parser.add_argument('--stage_path', help='local directory to copy the TFRecords to once for all trials', default=None)
+    args = parser.parse_args()
+
+    params = vars(args)
+    for i in params:
+        print('{} => {}'.format(i, params[i]))
+
+    main(**params)
@@ -0,0 +1,81 @@
+import time
+import pytest
+
+pytest.importorskip('tensorflow')
+from amlcallback import AMLCallback
+
+
+class FakeRun(object):
+    """Records what AMLCallback sends instead of talking to AML."""
+
+    def __init__(self, id='run-1'):
+        self.id = id
+        self.tables = []
+        self.logs = []
+        self.flushes = 0
+
+    def log_table(self, name, value):
+        self.tables.append((name, value))
+
+    def log(self, name, value):
+        self.logs.append((name, value))
+
+    def flush(self):
+        self.flushes += 1
+
+    def rows(self):
+        # log_table gets columns, possibly for several windows at once
+        rows = []
+        for _, table in self.tables:
+            keys = list(table.keys())
+            rows.extend(dict(zip(keys, values)) for values in zip(*[table[k] for k in keys]))
+        return rows
+
+
+def test_windows_aggregate_every_n_steps():
+    run = FakeRun()
+    callback = AMLCallback(run, every=100, interval=3600.)
+    callback.on_train_begin()
+    for i in range(250):
+        callback.on_train_batch_end(i, { 'batch': i, 'size': 10, 'loss': float(i), 'accuracy': 0.5 })
+    callback.on_train_end({ 'loss': 1.0 })
+
+    assert all(name == 'batch' for name, _ in run.tables)
+    rows = run.rows()
+    assert [r['step'] for r in rows] == [100, 200, 250]
+    assert [r['steps'] for r in rows] == [100, 100, 50]
+    assert rows[0]['loss_mean'] == pytest.approx(49.5)
+    assert (rows[0]['loss_min'], rows[0]['loss_max']) == (0., 99.)
+    assert rows[2]['loss_mean'] == pytest.approx(224.5)
+    assert (rows[2]['loss_min'], rows[2]['loss_max']) == (200., 249.)
+    assert rows[1]['accuracy_mean'] == pytest.approx(0.5)
+    assert not any(k.startswith('batch_') or k.startswith('size_') for k in rows[0])
+
+    # on_train_end waits for the background thread and flushes the run
+    assert ('final_loss', 1.0) in run.logs
+    assert callback.worker is None
+    assert run.flushes == 1
+
+
+def test_windows_close_after_interval():
+    run = FakeRun()
+    callback = AMLCallback(run, every=1000, interval=0.05)
+    callback.on_train_begin()
+    callback.on_train_batch_end(0, { 'loss': 1.0 })
+    time.sleep(0.1)
+    callback.on_train_batch_end(1, { 'loss': 3.0 })
+    callback.on_train_end()
+
+    rows = run.rows()
+    assert len(rows) == 1
+    assert rows[0]['steps'] == 2
+    assert rows[0]['loss_mean'] == pytest.approx(2.0)
+
+
+def test_offline_run_logs_nothing():
+    run = FakeRun(id='OfflineRun_1')
+    callback = AMLCallback(run)
+    callback.on_train_begin()
+    callback.on_train_batch_end(0, { 'loss': 1.0 })
+    callback.on_train_end({ 'loss': 1.0 })
+    assert run.tables == [] and run.logs == []
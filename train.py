@@ -1,16 +1,25 @@
 import os
 import csv
+import glob
 import json
 import math
+import time
+import shutil
+import hashlib
 import argparse
+import tempfile
+import multiprocessing.pool
 import numpy as np
 import tensorflow as tf
 from pathlib import Path
 from datetime import datetime
 from azureml.core.run import Run
 from amlcallback import AMLCallback
+from profilecallback import ProfileCallback
 from tensorflow.keras.callbacks import ModelCheckpoint
 
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
 # Create a dictionary describing the features.
 image_feature_description = {
     'height': tf.io.FixedLenFeature([], tf.int64),
@@ -26,7 +35,12 @@ def info(msg, char = "#", width = 75):
     print(char + "   %0*s" % ((-1*width)+5, msg) + char)
     print(char * width)
 
-def split(records, split=[8, 2]):
+def split(records, split=[8, 2], train_files=None):
+    # prep lists training shards first and says where they end, older
+    # listings are cut by position
+    if train_files is not None:
+        return records[:train_files], records[train_files:]
+
     # normalize splits
     splits = np.array(split) / np.sum(np.array(split))
     # split data
@@ -35,65 +49,339 @@ def split(records, split=[8, 2]):
     return records[:train_idx], \
             records[train_idx:]
 
-def parse_record(example_proto):
+def feature_description(record_format='float'):
+    # everything but legacy 'float' datasets stores the image as a single string
+    description = dict(image_feature_description)
+    if record_format != 'float':
+        description['image'] = tf.io.FixedLenFeature([], tf.string)
+    return description
+
+def decode_image(image, shape, record_format='float'):
+    if record_format == 'float':
+        return tf.reshape(image, shape)
+    elif record_format == 'uint8':
+        image = tf.reshape(tf.io.decode_raw(image, tf.uint8), shape)
+    elif record_format == 'jpeg':
+        image = tf.reshape(tf.io.decode_jpeg(image, channels=3), shape)
+    elif record_format == 'png':
+        image = tf.reshape(tf.io.decode_png(image, channels=3), shape)
+    else:
+        raise ValueError('Unknown record format "{}"'.format(record_format))
+    return tf.cast(image, tf.float32) / 255
+
+def decode_batch(images, img_shape, record_format='float'):
+    shape = [-1] + list(img_shape)
+    if record_format == 'float':
+        return tf.reshape(images, shape)
+    elif record_format == 'uint8':
+        images = tf.reshape(tf.io.decode_raw(images, tf.uint8), shape)
+    elif record_format == 'jpeg':
+        images = tf.map_fn(lambda i: tf.io.decode_jpeg(i, channels=3), images, dtype=tf.uint8)
+    elif record_format == 'png':
+        images = tf.map_fn(lambda i: tf.io.decode_png(i, channels=3), images, dtype=tf.uint8)
+    else:
+        raise ValueError('Unknown record format "{}"'.format(record_format))
+    return tf.cast(tf.reshape(images, shape), tf.float32) / 255
+
+def load_records(source_path, prep):
+    # rows are "<shard>,<records>"; older listings only have the shard so
+    # every file is assumed to hold prep['records'] examples
+    records = os.path.join(source_path, prep['file'])
+    print('Loading {}'.format(records))
+    with open(records, 'r', newline='') as f:
+        rows = [row for row in csv.reader(f) if len(row) > 0]
+    return [(os.path.join(source_path, row[0].strip()),
+             int(row[1]) if len(row) > 1 else prep['records']) for row in rows]
+
+def parse_record(example_proto, record_format='float'):
     # Parse the input tf.Example proto using the dictionary above.
-    example = tf.io.parse_single_example(example_proto, image_feature_description)
+    example = tf.io.parse_single_example(example_proto, feature_description(record_format))
     shape = [example['height'], 
              example['width'], 
              example['depth']]
     
     label = example['label']
-    image = tf.reshape(example['image'], shape)
+    image = decode_image(example['image'], shape, record_format)
     return (image, label)
 
+def parse_batch(example_protos, img_shape, record_format='float'):
+    # one parse_example call for the whole batch instead of one per record
+    examples = tf.io.parse_example(example_protos, feature_description(record_format))
+    images = decode_batch(examples['image'], img_shape, record_format)
+    return (images, examples['label'])
 
-def main(run, source_path, target_path, epochs, batch, lr):
-    info('Preprocess')
-    
-    print(f'Using Tensorflow v.{tf.__version__}')
-    print(f'GPUs Available: {len(tf.config.experimental.list_physical_devices("GPU"))}')
+def legacy_dataset(filenames, record_format, compression, img_shape, batch, epochs=None, training=True, cache=None):
+    parser = lambda proto: parse_record(proto, record_format)
+    ds = tf.data.TFRecordDataset(filenames, compression_type=compression)
+    if not training:
+        ds = ds.map(parser)
+        if cache is not None:
+            ds = ds.cache(cache)
+        return ds.batch(batch)
 
-    if not os.path.exists(target_path):
-        os.makedirs(target_path)
+    ds = ds.map(map_func=parser, num_parallel_calls=5)
+    if cache is not None:
+        ds = ds.cache(cache)
+    ds = ds.shuffle(buffer_size=10000)
+    ds = ds.batch(batch)
+    ds = ds.prefetch(buffer_size=5)
+    return ds.repeat(epochs)
 
-    # load tfrecord metadata
-    prep_step = os.path.join(source_path, 'metadata.json')
-    with open(prep_step) as f:
+def fast_dataset(filenames, record_format, compression, img_shape, batch, epochs=None, training=True, cache=None):
+    files = tf.data.Dataset.from_tensor_slices(filenames)
+    if training:
+        files = files.shuffle(len(filenames))
+
+    # read several shards at once, order does not matter for training
+    ds = files.interleave(lambda f: tf.data.TFRecordDataset(f, compression_type=compression),
+                          cycle_length=AUTOTUNE,
+                          num_parallel_calls=AUTOTUNE)
+
+    parser = lambda protos: parse_batch(protos, img_shape, record_format)
+    if cache is not None:
+        # decode once into the cache, every later pass starts from there
+        ds = ds.batch(256).map(parser, num_parallel_calls=AUTOTUNE).unbatch()
+        ds = ds.cache(cache)
+        if training:
+            ds = ds.shuffle(buffer_size=10000)
+        ds = ds.batch(batch)
+    else:
+        if training:
+            ds = ds.shuffle(buffer_size=10000)
+
+        # batch the serialized protos first so parsing is vectorized
+        ds = ds.batch(batch)
+        ds = ds.map(parser, num_parallel_calls=AUTOTUNE)
+
+    # repeat after batching, every epoch then ends in its own partial batch
+    # and yields the ceil(N/batch) steps fit asks for
+    if training:
+        ds = ds.repeat(epochs)
+    ds = ds.prefetch(AUTOTUNE)
+
+    options = tf.data.Options()
+    options.experimental_deterministic = not training
+    return ds.with_options(options)
+
+PIPELINES = {
+    'legacy': legacy_dataset,
+    'fast': fast_dataset
+}
+
+def fingerprint(source_path):
+    # metadata.json changes (at least 'generated') every time prep runs
+    with open(os.path.join(source_path, 'metadata.json'), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+def cache_dir(cache_path, source_path, pipeline='fast'):
+    # pipelines cache different tensors (legacy ones have no static shape)
+    path = os.path.join(cache_path or os.path.join(tempfile.gettempdir(), 'seer-cache'),
+                        '{}-{}'.format(fingerprint(source_path), pipeline))
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+def clear_partial(prefix):
+    # tf writes <prefix>.index once the cache is complete, anything else
+    # under the prefix is left from a run that died while filling it and
+    # its lockfile would fail every later run
+    if os.path.exists(prefix + '.index'):
+        return
+    for filename in glob.glob(glob.escape(prefix) + '_*') + glob.glob(glob.escape(prefix) + '.*'):
+        print('Removing incomplete cache file {}'.format(filename))
+        os.remove(filename)
+
+def cache_files(cache, cache_path, source_path, pipeline='fast', suffix=''):
+    if cache == 'none':
+        return None, None
+    elif cache == 'memory':
+        return '', ''
+
+    path = cache_dir(cache_path, source_path, pipeline)
+    print('Caching decoded records in {}'.format(path))
+    files = [os.path.join(path, name + suffix) for name in ['train', 'test']]
+    for prefix in files:
+        clear_partial(prefix)
+    return files
+
+def fill_cache(ds):
+    # a cache is only kept once an iterator reaches the end of the data,
+    # validation_steps stops just short of that every epoch
+    start = time.perf_counter()
+    batches = sum(1 for _ in ds)
+    print('Cached {} test batches in {:.1f}s'.format(batches, time.perf_counter() - start))
+
+def stage(source_path, stage_path, workers=16, copy=shutil.copy2):
+    info('Staging')
+    with open(os.path.join(source_path, 'metadata.json')) as f:
         prep = json.load(f)
 
-    for i in prep:
-        print('{} => {}'.format(i, prep[i]))
+    files = ['metadata.json', prep['file']] + \
+            [os.path.relpath(filename, source_path) for filename, _ in load_records(source_path, prep)]
 
-    labels = prep['categories']
-    img_shape = (prep['image_size'], prep['image_size'], 3)
-    record_sz = prep['records']
+    def stage_file(rel_path):
+        source = os.path.join(source_path, rel_path)
+        target = os.path.join(stage_path, rel_path)
+        stat = os.stat(source)
+        # shards already staged by a previous run on this node are kept
+        if rel_path not in files[:2] and os.path.exists(target):
+            local = os.stat(target)
+            if local.st_size == stat.st_size and int(local.st_mtime) == int(stat.st_mtime):
+                return 0
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        copy(source, target)
+        return stat.st_size
 
-    records = os.path.join(source_path, prep['file'])
-    print('Loading {}'.format(records))
-    with open(records, 'r') as f:
-        filenames = [os.path.join(source_path, s.strip()) for s in f.readlines()]
-    
-    print('Splitting data:')
-    train, test = split(filenames)
-    print('  Train: {}'.format(len(train)))
-    print('   Test: {}'.format(len(test)))
-
-    print('Creating training dataset')
-    train_ds = tf.data.TFRecordDataset(train)
-    train_ds = train_ds.map(map_func=parse_record, num_parallel_calls=5)
-    train_ds = train_ds.shuffle(buffer_size=10000)
-    train_ds = train_ds.batch(batch)
-    train_ds = train_ds.prefetch(buffer_size=5)
-    train_ds = train_ds.repeat(epochs)
-
-
-    # model
-    info('Creating Model')
-    base_model = tf.keras.applications.MobileNetV2(input_shape=img_shape,
-                                               include_top=False, 
-                                               weights='imagenet',
-                                               pooling='avg')
+    start = time.perf_counter()
+    with multiprocessing.pool.ThreadPool(workers) as pool:
+        sizes = pool.map(stage_file, files)
+    elapsed = time.perf_counter() - start
+
+    copied = sum(sizes) / (1024 * 1024)
+    report = {
+        'files': len(files),
+        'copied_files': len([s for s in sizes if s > 0]),
+        'copied_mb': copied,
+        'seconds': elapsed,
+        'mb_per_sec': copied / elapsed if elapsed > 0 else 0
+    }
+    print('Staged {copied_files} of {files} files, {copied_mb:.1f} MB in {seconds:.1f}s ({mb_per_sec:.1f} MB/s)'.format(**report))
+    return report
+
+
+def cluster():
+    # (worker count, worker index, is chief) from TF_CONFIG, which AML
+    # sets for distributed runs and launch.py sets locally
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    spec = tf_config.get('cluster', {})
+    task = tf_config.get('task', { 'type': 'worker', 'index': 0 })
+    chiefs = len(spec.get('chief', []))
+    workers = chiefs + len(spec.get('worker', []))
+    index = task['index'] + (chiefs if task['type'] == 'worker' else 0)
+    is_chief = task['type'] == 'chief' or (chiefs == 0 and task['index'] == 0)
+    return max(workers, 1), index, is_chief
+
+def worker_files(filenames, workers, index):
+    # disjoint slice of shards per worker, everybody reads everything if
+    # there are not enough shards to go around
+    if len(filenames) < workers:
+        return filenames
+    return filenames[index::workers]
+
+def embeddings(base_model, ds, path):
+    # pooled features of the frozen base model, computed once per dataset
+    if os.path.exists(path):
+        print('Loading embeddings from {}'.format(path))
+        cached = np.load(path)
+        return cached['features'], cached['labels']
+
+    print('Computing embeddings into {}'.format(path))
+    features, labels = [], []
+    for images, label in ds:
+        features.append(base_model(images, training=False).numpy())
+        labels.append(label.numpy())
+
+    features, labels = np.concatenate(features), np.concatenate(labels)
+    np.savez(path, features=features, labels=labels)
+    return features, labels
+
+class BestWeights(tf.keras.callbacks.Callback):
+    def __init__(self, monitor='val_accuracy'):
+        super(BestWeights, self).__init__()
+        self.monitor = monitor
+        self.best = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None and (self.best is None or logs[self.monitor] > self.best['logs'][self.monitor]):
+            self.best = { 'epoch': epoch + 1, 'logs': dict(logs), 'weights': self.model.get_weights() }
+
+def train_bottleneck(base_model, labels, train_ds, test_ds, embedding_path, target_path, epochs, batch, lr, callbacks):
+    info('Embeddings')
+    base_model.trainable = False
+    start = time.perf_counter()
+    train_x, train_y = embeddings(base_model, train_ds, os.path.join(embedding_path, 'embeddings-train.npz'))
+    test_x, test_y = embeddings(base_model, test_ds, os.path.join(embedding_path, 'embeddings-test.npz'))
+    print('Embeddings ready in {:.1f}s: {} train, {} test'.format(time.perf_counter() - start, len(train_x), len(test_x)))
+
+    info('Training Head')
+    head = tf.keras.layers.Dense(len(labels), activation='softmax')
+    classifier = tf.keras.Sequential([tf.keras.layers.InputLayer(input_shape=(train_x.shape[1],)), head])
+    classifier.compile(optimizer=tf.keras.optimizers.Adam(lr=lr),
+                       loss='sparse_categorical_crossentropy',
+                       metrics=['accuracy'])
 
+    best = BestWeights()
+    start = time.perf_counter()
+    classifier.fit(train_x, train_y,
+                   batch_size=batch,
+                   epochs=epochs,
+                   callbacks=callbacks + [best],
+                   validation_data=(test_x, test_y),
+                   verbose=2)
+    print('Head trained in {:.1f}s'.format(time.perf_counter() - start))
+
+    # same Sequential([base_model, Dense]) layout the fine-tuned model has
+    classifier.set_weights(best.best['weights'])
+    model = tf.keras.Sequential([base_model, head])
+    model.compile(optimizer=tf.keras.optimizers.Adam(lr=lr),
+                  loss='sparse_categorical_crossentropy',
+                  metrics=['accuracy'])
+
+    filename = datetime.now().strftime("%d.%b.%Y.%H.%M")
+    model_file = os.path.join(target_path, filename + '.e{:02d}-{:.2f}-v{:.2f}.hdf5'.format(
+        best.best['epoch'], best.best['logs']['accuracy'], best.best['logs']['val_accuracy']))
+    print('Saving best model (epoch {}) to {}'.format(best.best['epoch'], model_file))
+    model.save(model_file)
+    return model
+
+class CheckpointCallback(tf.keras.callbacks.Callback):
+    def __init__(self, checkpoint, manager, every=0, offset=0):
+        super(CheckpointCallback, self).__init__()
+        self.checkpoint = checkpoint
+        self.manager = manager
+        self.every = every
+        # steps of the current epoch finished before a resume
+        self.offset = offset
+
+    def save(self, epoch, step):
+        self.checkpoint.epoch.assign(epoch)
+        self.checkpoint.step.assign(step)
+        path = self.manager.save()
+        print('\nSaved checkpoint {} (epoch {}, step {})'.format(path, epoch, step))
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.every > 0 and (self.offset + batch + 1) % self.every == 0:
+            self.save(self.epoch, self.offset + batch + 1)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.offset = 0
+        if logs is not None and 'val_accuracy' in logs:
+            self.checkpoint.val_accuracy.assign(logs['val_accuracy'])
+        self.save(epoch + 1, 0)
+
+def restore(checkpoint, manager):
+    # newest checkpoint that actually loads, a preempted save can leave a
+    # broken one behind. restore() is deferred and rarely raises by itself,
+    # the assert is what catches missing or mismatched variables
+    weights = checkpoint.model.get_weights()
+    for path in reversed(manager.checkpoints):
+        try:
+            checkpoint.restore(path).assert_existing_objects_matched()
+            print('Resuming from {} (epoch {}, step {})'.format(path, int(checkpoint.epoch), int(checkpoint.step)))
+            return int(checkpoint.epoch), int(checkpoint.step)
+        except Exception as e:
+            print('Skipping checkpoint {} ({})'.format(path, e))
+            # a failed restore may have assigned some variables already
+            checkpoint.model.set_weights(weights)
+            checkpoint.epoch.assign(0)
+            checkpoint.step.assign(0)
+    return 0, 0
+
+def finetune(base_model, labels, train_ds, test_ds, target_path, epochs, batch, lr, callbacks,
+             steps_per_epoch, test_steps, checkpoint_path=None, restore_path=None, checkpoint_steps=0):
     base_model.trainable = True
 
     model = tf.keras.Sequential([
@@ -111,25 +399,181 @@ def main(run, source_path, target_path, epochs, batch, lr):
     # training
     info('Training')
 
-    # callbacks
-    logaml = AMLCallback(run)
     filename = datetime.now().strftime("%d.%b.%Y.%H.%M")
     checkpoint = ModelCheckpoint(os.path.join(target_path, filename + '.e{epoch:02d}-{accuracy:.2f}-v{val_accuracy:.2f}.hdf5'),
                                  monitor='val_accuracy',
                                  save_best_only=True)
 
-    # using both test and val in this case
-    test_ds = tf.data.TFRecordDataset(test).map(parse_record).batch(batch)
-    test_steps = math.ceil((len(test)*record_sz)/batch)
+    # full training state (weights, optimizer slots, position) for resuming
+    state = tf.train.Checkpoint(model=model, optimizer=model.optimizer,
+                                epoch=tf.Variable(0, dtype=tf.int64), step=tf.Variable(0, dtype=tf.int64),
+                                val_accuracy=tf.Variable(0., dtype=tf.float32))
+    checkpoint_path = checkpoint_path or os.path.join(target_path, 'checkpoints')
+    initial_epoch, initial_step = restore(state, tf.train.CheckpointManager(state, restore_path or checkpoint_path, max_to_keep=2))
+    resume = CheckpointCallback(state, tf.train.CheckpointManager(state, checkpoint_path, max_to_keep=2),
+                                checkpoint_steps, initial_step)
+
+    if initial_step >= steps_per_epoch:
+        initial_epoch, initial_step = initial_epoch + 1, 0
+        resume.offset = 0
 
+    if initial_epoch >= epochs:
+        print('Already trained for {} epochs'.format(initial_epoch))
+        return model
+
+    # finish a partially trained epoch first, then carry on as usual
+    if initial_step > 0:
+        model.fit(train_ds,
+                  initial_epoch=initial_epoch,
+                  epochs=initial_epoch + 1,
+                  steps_per_epoch=steps_per_epoch - initial_step,
+                  callbacks=callbacks + [checkpoint, resume],
+                  validation_data=test_ds,
+                  validation_steps=test_steps)
+        initial_epoch += 1
+
+    if initial_epoch < epochs:
+        history = model.fit(train_ds, 
+                        initial_epoch=initial_epoch,
+                        epochs=epochs, 
+                        steps_per_epoch=steps_per_epoch,
+                        callbacks=callbacks + [checkpoint, resume],
+                        validation_data=test_ds,
+                        validation_steps=test_steps)
+    return model
+
+def main(run, source_path, target_path, epochs, batch, lr, pipeline='fast',
+         stage_path=None, stage_workers=16, cache='none', cache_path=None, mode='finetune', distributed=False,
+         checkpoint_steps=0, profile=False, profile_steps=None):
+    info('Preprocess')
+    checkpoint_path = os.path.join(target_path, 'checkpoints')
+
+    # the profiler marks batches of train_ds, which bottleneck training never reads
+    if profile and mode == 'bottleneck':
+        raise Exception('Profiling is only supported for finetune training!')
+    # distributed datasets prefetch ahead of the step, the input wait
+    # marks would fire before the step asks for its batch
+    if profile and distributed:
+        raise Exception('Profiling is only supported for single node training!')
+
+    # the strategy has to exist before anything else touches the runtime
+    workers, worker_index, is_chief = 1, 0, True
+    strategy = tf.distribute.get_strategy()
+    if distributed:
+        if mode == 'bottleneck':
+            raise Exception('Bottleneck training runs on a single node!')
+        strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
+        workers, worker_index, is_chief = cluster()
+        print('Worker {} of {}{}'.format(worker_index + 1, workers, ' (chief)' if is_chief else ''))
+
+        # linear scaling: same per worker batch, proportionally larger step
+        batch, lr = batch * workers, lr * workers
+        print('Global batch {}, learning rate {}'.format(batch, lr))
+
+        # only the chief keeps checkpoints and metadata
+        if not is_chief:
+            target_path = tempfile.mkdtemp(prefix='seer-worker{}-'.format(worker_index))
     
-    steps_per_epoch = math.ceil((len(train)*record_sz)/batch)
-    history = model.fit(train_ds, 
-                    epochs=epochs, 
-                    steps_per_epoch=steps_per_epoch,
-                    callbacks=[logaml, checkpoint],
-                    validation_data=test_ds,
-                    validation_steps=test_steps)
+    print(f'Using Tensorflow v.{tf.__version__}')
+    print(f'GPUs Available: {len(tf.config.experimental.list_physical_devices("GPU"))}')
+
+    if not os.path.exists(target_path):
+        os.makedirs(target_path)
+
+    # copy shards off the mount once instead of reading it every epoch
+    if stage_path is not None:
+        report = stage(source_path, stage_path, stage_workers)
+        if not run.id.startswith('OfflineRun'):
+            for k in report:
+                run.log(f'stage_{k}', report[k])
+        source_path = stage_path
+
+    # load tfrecord metadata
+    prep_step = os.path.join(source_path, 'metadata.json')
+    with open(prep_step) as f:
+        prep = json.load(f)
+
+    for i in prep:
+        print('{} => {}'.format(i, prep[i]))
+
+    if prep.get('format_version', 1) < 3:
+        print('Warning: records were decoded differently from score.py, rerun prep.py to avoid train/serve skew')
+
+    labels = prep['categories']
+    img_shape = (prep['image_size'], prep['image_size'], 3)
+    record_format = prep.get('format', 'float')
+    compression = prep.get('compression', '')
+
+    records = load_records(source_path, prep)
+    
+    print('Splitting data:')
+    train, test = split(records, train_files=prep.get('train_files'))
+    train_count = sum(count for _, count in train)
+    test_count = sum(count for _, count in test)
+    train = [filename for filename, _ in train]
+    test = [filename for filename, _ in test]
+    print('  Train: {} ({} records)'.format(len(train), train_count))
+    print('   Test: {} ({} records)'.format(len(test), test_count))
+
+    print('Creating training dataset ({} pipeline)'.format(pipeline))
+    make_dataset = PIPELINES[pipeline]
+    train_cache, test_cache = cache_files(cache, cache_path, source_path, pipeline,
+                                          '-{}of{}'.format(worker_index, workers) if distributed else '')
+    if distributed:
+        # each worker reads its own shards (batches are global, the strategy
+        # splits them per replica) and repeats forever so uneven slices
+        # never run dry before steps_per_epoch
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        train_ds = make_dataset(worker_files(train, workers, worker_index), record_format, compression,
+                                img_shape, batch, None, cache=train_cache).with_options(options)
+        test_ds = make_dataset(worker_files(test, workers, worker_index), record_format, compression,
+                               img_shape, batch, training=False, cache=test_cache)
+        if test_cache is not None:
+            fill_cache(test_ds)
+        test_ds = test_ds.repeat().with_options(options)
+    else:
+        train_ds = make_dataset(train, record_format, compression, img_shape, batch, epochs, cache=train_cache)
+
+        # using both test and val in this case
+        test_ds = make_dataset(test, record_format, compression, img_shape, batch, training=False, cache=test_cache)
+        if test_cache is not None:
+            fill_cache(test_ds)
+
+    test_steps = math.ceil(test_count/batch)
+
+    # callbacks
+    logaml = AMLCallback(run)
+    callbacks = [logaml]
+    if profile:
+        trace_steps = tuple(int(s) for s in profile_steps.split(',')) if profile_steps else None
+        profiler = ProfileCallback(run, target_path, trace_steps)
+        train_ds = profiler.wrap(train_ds)
+        callbacks.append(profiler)
+
+    with strategy.scope():
+        # model
+        info('Creating Model')
+        base_model = tf.keras.applications.MobileNetV2(input_shape=img_shape,
+                                                   include_top=False, 
+                                                   weights='imagenet',
+                                                   pooling='avg')
+
+        if mode == 'bottleneck':
+            # frozen base, only the softmax head is trained on cached features
+            train_eval_ds = make_dataset(train, record_format, compression, img_shape, batch, training=False)
+            train_bottleneck(base_model, labels, train_eval_ds, test_ds, cache_dir(cache_path, source_path, pipeline),
+                             target_path, epochs, batch, lr, callbacks)
+        else:
+            # every worker resumes from the chief's checkpoints but saves its own
+            finetune(base_model, labels, train_ds, test_ds, target_path, epochs, batch, lr, callbacks,
+                     math.ceil(train_count/batch), test_steps,
+                     os.path.join(target_path, 'checkpoints'), checkpoint_path, checkpoint_steps)
+
+    if not is_chief:
+        shutil.rmtree(target_path, ignore_errors=True)
+        print('Done!')
+        return
 
     info('Writing metadata')
     out_file = os.path.join(target_path, 'metadata.json')
@@ -137,6 +581,8 @@ def main(run, source_path, target_path, epochs, batch, lr):
         'image_size': prep['image_size'],
         'categories': prep['categories'],
         'index': prep['index'],
+        'mode': mode,
+        'workers': workers,
         'generated': datetime.now().strftime('%m/%d/%y %H:%M:%S'),
         'run': str(run.id)
     }
@@ -153,6 +599,16 @@ if __name__ == "__main__":
     parser.add_argument('-e', '--epochs', help='number of epochs', default=10, type=int)
     parser.add_argument('-b', '--batch', help='batch size', default=32, type=int)
     parser.add_argument('-l', '--lr', help='learning rate', default=0.0001, type=float)
+    parser.add_argument('--stage_path', help='local directory to copy the TFRecords to before training', default=None)
+    parser.add_argument('--stage_workers', help='parallel copies when staging', default=16, type=int)
+    parser.add_argument('--cache', help='cache decoded records across epochs', default='none', choices=['none', 'memory', 'disk'])
+    parser.add_argument('--cache_path', help='disk cache directory (temp dir if omitted)', default=None)
+    parser.add_argument('-m', '--mode', help='fine tune everything or train the head on cached embeddings', default='finetune', choices=['finetune', 'bottleneck'])
+    parser.add_argument('--checkpoint_steps', help='also checkpoint every n steps (0 = end of epoch only)', default=0, type=int)
+    parser.add_argument('--profile', help='record input wait vs compute per step into profile.json (single node finetune only)', default=False, action='store_true')
+    parser.add_argument('--profile_steps', help='capture a TF profiler trace for steps "first,last"', default=None)
+    parser.add_argument('-d', '--distributed', help='multi worker training (cluster from TF_CONFIG)', default=False, action='store_true')
+    parser.add_argument('-p', '--pipeline', help='input pipeline', default='fast', choices=list(PIPELINES.keys()))
     args = parser.parse_args()
 
     run = Run.get_context()